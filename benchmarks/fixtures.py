@@ -0,0 +1,63 @@
+"""Synthetic hg-manager deployments for the benchmarks
+
+make_deployment() writes an hgweb.config with N [collections], the
+repositories under them (each an .hg directory with a requires file and
+an hgrc [web] section) and a .htdigest users file.  Nothing is run
+through Mercurial, so the fixtures can be built quickly at any scale.
+"""
+import os
+import random
+
+realm = 'mercurial repository'
+
+def user_name(i):
+    return 'user%d' % i
+
+def repo_name(c, i):
+    return 'repo%d-%d' % (c, i)
+
+def make_deployment(root, collections=1, repos=100, users=1000,
+                    members=3, wildcard=0.05, seed=0):
+    """Create a deployment under root and return a description of it.
+
+    repos repositories are spread evenly over the collections.  Each
+    grants members random users read access and one of them push access;
+    a wildcard fraction of them allow everyone to read.
+    """
+    rnd = random.Random(seed)
+    config = os.path.join(root, 'hgweb.config')
+    users_file = os.path.join(root, '.htdigest')
+
+    with open(users_file, 'w') as f:
+        f.writelines(['%s:%s:%032x\n' % (user_name(i), realm, rnd.getrandbits(128))
+                      for i in range(users)])
+
+    names = []
+    roots = []
+    for c in range(collections):
+        croot = os.path.join(root, 'collection%d' % c)
+        os.mkdir(croot)
+        roots.append(croot)
+    for i in range(repos):
+        c = i % collections
+        name = repo_name(c, i)
+        hgdir = os.path.join(roots[c], name, '.hg')
+        os.makedirs(hgdir)
+        with open(os.path.join(hgdir, 'requires'), 'w') as f:
+            f.write('revlogv1\nstore\nfncache\ndotencode\n')
+        acl = [user_name(rnd.randrange(users)) for j in range(members)]
+        with open(os.path.join(hgdir, 'hgrc'), 'w') as f:
+            if rnd.random() < wildcard:
+                f.write('[web]\nallow_push = %s\n' % acl[0])
+            else:
+                f.write('[web]\nallow_read = %s\nallow_push = %s\n' % (
+                    ','.join(acl), acl[0]))
+        names.append(name)
+
+    with open(config, 'w') as f:
+        f.write('[collections]\n')
+        for c, croot in enumerate(roots):
+            f.write('collection%d = %s\n' % (c, croot))
+
+    return {'root': root, 'config': config, 'users_file': users_file,
+            'repos': names, 'users': users, 'collections': collections}
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""Scale benchmark for hg-manager
+
+Builds synthetic deployments of growing size in a temp directory (see
+fixtures.py) and times each subcommand against them, both with cold
+caches (ACL index and discovery cache removed) and warm ones.  Results
+are written as one JSON object per line, or as CSV, so that scaling
+curves can be compared across changes:
+
+    python benchmarks/scale.py --repos 1000 10000 --users 10000 100000 > new.ndjson
+"""
+import os
+import sys
+import csv
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from fixtures import make_deployment, user_name
+
+default_script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              os.pardir, 'hg-manager.py')
+
+# Caches hg-manager keeps next to hgweb.config
+cache_files = ['.hg-manager-acl.json', '.hg-manager-repos.json']
+
+fields = ['collections', 'repos', 'users', 'command', 'cache', 'run',
+          'seconds', 'status']
+
+def steps(deployment, members):
+    """Returns the (command, setup, argv, teardown) steps to time.
+
+    Setup and teardown command lines are run untimed, so every timed
+    run starts from the same state.
+    """
+    user = user_name(1)
+    repo = deployment['repos'][0]
+    grant = deployment['repos'][:members]
+    new_user = ['add', 'bench-user', 'secret']
+    del_user = ['rm', '-f', 'bench-user']
+    return [
+        ('ls', [], ['ls'], []),
+        ('ls <user>', [], ['ls', user], []),
+        ('lsr', [], ['lsr'], []),
+        ('lsr <repo>', [], ['lsr', repo], []),
+        ('add', [], new_user, [del_user]),
+        ('rm', [new_user, ['adduser', 'bench-user'] + grant], del_user, []),
+        ('adduser', [new_user], ['adduser', 'bench-user'] + grant, [del_user]),
+        ('deluser', [new_user, ['adduser', 'bench-user'] + grant],
+         ['deluser', 'bench-user'] + grant, [del_user]),
+        ('create', [], ['create', 'bench-repo'], [['delete', '-f', 'bench-repo']]),
+        ('delete', [['create', 'bench-repo']], ['delete', '-f', 'bench-repo'], []),
+    ]
+
+def run(script, deployment, argv):
+    """Run hg-manager, returning (seconds, exit status)."""
+    cmd = [sys.executable, script, '-c', deployment['config'],
+           '-u', deployment['users_file']] + argv
+    devnull = open(os.devnull, 'w')
+    start = time.time()
+    status = subprocess.call(cmd, stdout=devnull, stderr=devnull,
+                             cwd=deployment['root'])
+    return time.time() - start, status
+
+def clear_caches(deployment):
+    for name in cache_files:
+        path = os.path.join(deployment['root'], name)
+        if os.path.exists(path):
+            os.unlink(path)
+
+def bench(script, deployment, runs, members, only):
+    """Yields one result dict per timed run."""
+    for command, setup, argv, teardown in steps(deployment, members):
+        if only and command not in only:
+            continue
+        for i in range(runs):
+            for c in setup:
+                run(script, deployment, c)
+            if i == 0:
+                clear_caches(deployment)
+            seconds, status = run(script, deployment, argv)
+            for c in teardown:
+                run(script, deployment, c)
+            yield {'collections': deployment['collections'],
+                   'repos': len(deployment['repos']),
+                   'users': deployment['users'], 'command': command,
+                   'cache': i == 0 and 'cold' or 'warm', 'run': i,
+                   'seconds': round(seconds, 6), 'status': status}
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--script', default=default_script,
+                        help='hg-manager.py to benchmark')
+    parser.add_argument('--collections', type=int, default=4,
+                        help='collections per deployment')
+    parser.add_argument('--repos', type=int, nargs='+', default=[1000, 10000],
+                        help='repositories per deployment, one per size')
+    parser.add_argument('--users', type=int, nargs='+', default=[100000],
+                        help='users per deployment, one per size or one for all')
+    parser.add_argument('--members', type=int, default=10,
+                        help='repositories touched by adduser, deluser and rm')
+    parser.add_argument('-n', '--runs', type=int, default=3,
+                        help='runs per command; the first one is cold')
+    parser.add_argument('--command', action='append', dest='only',
+                        help='only time this command (repeatable)')
+    parser.add_argument('--csv', action='store_true',
+                        help='write CSV instead of JSON lines')
+    parser.add_argument('-o', '--output', help='write the results to a file')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the generated deployments')
+    args = parser.parse_args()
+
+    if len(args.users) == 1:
+        args.users = args.users * len(args.repos)
+    if len(args.users) != len(args.repos):
+        parser.error('--users needs one value, or one per --repos value')
+
+    out = args.output and open(args.output, 'w') or sys.stdout
+    writer = None
+    if args.csv:
+        writer = csv.DictWriter(out, fields)
+        writer.writeheader()
+
+    script = os.path.abspath(args.script)
+    for repos, users in zip(args.repos, args.users):
+        root = tempfile.mkdtemp(prefix='hg-manager-scale-')
+        try:
+            start = time.time()
+            deployment = make_deployment(root, args.collections, repos, users)
+            sys.stderr.write("Generated %d repositories and %d users in %.1fs (%s)\n" % (
+                repos, users, time.time() - start, root))
+            for result in bench(script, deployment, args.runs, args.members, args.only):
+                if writer:
+                    writer.writerow(result)
+                else:
+                    out.write(json.dumps(result, sort_keys=True) + '\n')
+                out.flush()
+        finally:
+            if not args.keep:
+                shutil.rmtree(root, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""Cold-start benchmark for hg-manager
+
+Times the read-only commands (ls, lsr) in fresh interpreters against a
+small deployment in a temp directory, and reports which modules they
+import.  Read-only commands must not load any of the heavy modules
+below; the benchmark exits with status 1 if they do, or if a command is
+slower than --max-ms.
+
+Compare against an older revision with, e.g.:
+    git show HEAD~1:hg-manager.py > /tmp/old.py
+    python benchmarks/startup.py --compare /tmp/old.py
+"""
+import os
+import sys
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from fixtures import make_deployment
+
+# Modules that only the writing commands need
+heavy_modules = ['mercurial', 'email', 'smtplib', 'multiprocessing',
+                 'SocketServer', 'csv', 'crypt']
+
+# Read-only commands to time
+commands = [['ls'], ['ls', 'user0'], ['lsr'], ['lsr', 'repo0-0']]
+
+default_script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              os.pardir, 'hg-manager.py')
+
+# Runs one command in-process, timing the first import of every module
+child = r'''
+import sys, time, json, imp, __builtin__
+from StringIO import StringIO
+script, argv = sys.argv[1], sys.argv[2:]
+times = {}
+_import = __builtin__.__import__
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules or name in times:
+        return _import(name, *args, **kwargs)
+    start = time.time()
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        times[name] = time.time() - start
+__builtin__.__import__ = timed_import
+start = time.time()
+error = None
+stdout = sys.stdout
+sys.stdout = StringIO()
+try:
+    sys.argv = [script] + argv
+    imp.load_source('hg_manager', script).main()
+except BaseException, e:
+    error = repr(e)
+sys.stdout = stdout
+print json.dumps({'elapsed': time.time() - start, 'error': error,
+                  'modules': sorted(set([m.split('.')[0] for m in sys.modules])),
+                  'imports': sorted(times.items(), key=lambda x: -x[1])[:10]})
+'''
+
+def bench(script, deployment, argv, runs):
+    """Returns (wall times, in-process report) of a command."""
+    root = deployment['root']
+    base = [sys.executable, script, '-c', deployment['config'],
+            '-u', deployment['users_file']]
+    devnull = open(os.devnull, 'w')
+    times = []
+    for i in range(runs):
+        start = time.time()
+        subprocess.call(base + argv, stdout=devnull, stderr=devnull, cwd=root)
+        times.append(time.time() - start)
+    out = subprocess.check_output([sys.executable, '-c', child, script,
+                                   '-c', base[3], '-u', base[5]] + argv, cwd=root)
+    return sorted(times), json.loads(out)
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=10,
+                        help='runs per command')
+    parser.add_argument('--repos', type=int, default=100,
+                        help='repositories in the fixture')
+    parser.add_argument('--users', type=int, default=1000,
+                        help='users in the fixture')
+    parser.add_argument('--compare', action='append', default=[],
+                        help='another hg-manager.py to benchmark')
+    parser.add_argument('--max-ms', type=float,
+                        help='fail if a median run is slower than this')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='hg-manager-startup-')
+    results = []
+    try:
+        deployment = make_deployment(root, repos=args.repos, users=args.users)
+        for script in [default_script] + args.compare:
+            for argv in commands:
+                times, report = bench(os.path.abspath(script), deployment, argv, args.runs)
+                results.append({'script': script, 'command': ' '.join(argv),
+                                'min_ms': times[0] * 1000,
+                                'median_ms': times[len(times) // 2] * 1000,
+                                'heavy': [m for m in heavy_modules
+                                          if m in report['modules']],
+                                'error': report['error'],
+                                'imports': report['imports']})
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    failed = False
+    for r in results:
+        if r['script'] != default_script:
+            continue
+        if r['heavy'] or r['error'] or (args.max_ms and r['median_ms'] > args.max_ms):
+            failed = True
+
+    if args.json:
+        print json.dumps(results, indent=2)
+    else:
+        for r in results:
+            print "%-40s %-12s min %7.1fms  median %7.1fms  heavy: %s%s" % (
+                os.path.relpath(r['script']), r['command'], r['min_ms'],
+                r['median_ms'], ', '.join(r['heavy']) or '-',
+                r['error'] and '  error: %s' % r['error'] or '')
+            for name, t in r['imports'][:5]:
+                print "    %-30s %7.1fms" % (name, t * 1000)
+    sys.exit(failed and 1 or 0)
+
+if __name__ == '__main__':
+    main()
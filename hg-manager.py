@@ -15,28 +15,32 @@ import sys
 import ConfigParser
 import random
 import string
-import smtplib
 import shutil
+import time
+import json
 from argparse import ArgumentParser
-from email.mime.text import MIMEText
-from mercurial import ui, hg, commands
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
 
-# We need a crypt module, but Windows doesn't have one by default.  Try to find
-# one, and tell the user if we can't.
+# Heavier modules (mercurial, email, smtplib, socket, multiprocessing, csv,
+# crypt, ...) are imported by the functions that need them, so that the
+# read-only commands start quickly.  benchmarks/startup.py checks this.
+
+# os.scandir() is only in Python 3.5+; use the scandir backport if present.
 try:
-    import crypt
+    from os import scandir
 except ImportError:
     try:
-        import fcrypt as crypt
+        from scandir import scandir
     except ImportError:
-        sys.stderr.write("Cannot find a crypt module.  "
-                         "Possibly http://carey.geek.nz/code/python-fcrypt/\n")
-        sys.exit(1)
+        scandir = None
 
+# File locking is only available on POSIX systems.
 try:
-    from hashlib import md5
+    import fcntl
 except ImportError:
-    from md5 import md5
+    fcntl = None
 
 #
 # Global Configuration
@@ -59,6 +63,79 @@ repo_ssh_url = 'ssh://hg@garkbit.osl.iu.edu'
 
 repo_maintainer = 'adkulkar@garkbit.osl.iu.edu'
 
+# SMTP server used to deliver notification emails
+smtp_host = 'localhost'
+smtp_port = 25
+smtp_timeout = 30
+
+# Number of messages sent per SMTP session
+smtp_batch = 100
+
+# Delivery attempts per message, and the delay (in seconds) before the
+# first retry; the delay doubles after every failed attempt
+smtp_retries = 5
+smtp_backoff = 60
+
+# Time (in seconds) a message that could not be delivered is kept in the
+# spool's 'failed' subdirectory before it is purged
+smtp_failed_keep = 7 * 24 * 3600
+
+# Default Unix socket of the 'serve' daemon
+default_socket = '.hg-manager.sock'
+
+# Users files with these extensions are kept in a DBM or SQLite database
+# instead of a flat htpasswd/htdigest file
+dbm_extensions = ['.db', '.dbm']
+sqlite_extensions = ['.sqlite', '.sqlite3']
+
+# Number of successful credential checks remembered by 'check'
+check_cache_size = 4096
+
+# Name of the notification email spool, kept next to the users file
+mail_spool_dir = '.hg-manager-spool'
+
+# Number of hgrc files edited concurrently by batched ACL changes
+acl_jobs = 8
+
+# Number of repositories materialized concurrently by 'create --skeleton'
+# and 'fork'
+create_jobs = 8
+
+# Name of the ACL index cache, kept next to the hgweb configuration file
+acl_index_file = '.hg-manager-acl.json'
+
+# Name of the repository discovery cache, kept next to the hgweb configuration file
+repo_cache_file = '.hg-manager-repos.json'
+
+# Name of the repository statistics cache, kept next to the hgweb configuration file
+stats_cache_file = '.hg-manager-stats.json'
+
+# Name of the operation journal, kept next to the hgweb configuration file
+journal_file = '.hg-manager-journal'
+
+# Deleted repositories are moved to this directory, created next to them
+# so the move is a rename on the same filesystem
+trash_dir = '.hg-manager-trash'
+
+# hgweb serves any directory with a '.hg' under a collection, so a deleted
+# repository's '.hg' is renamed to this before it is moved to the trash
+trashed_hg_dir = '.hg-trashed'
+
+# Name of the 'maintain' results log, kept next to the hgweb configuration file
+maintain_state_file = '.hg-manager-maintain.json'
+
+# Number of repositories checked concurrently by 'maintain', the maximum
+# number of them on any one filesystem, and the time (in seconds) after
+# which a check is killed
+maintain_jobs = 4
+maintain_io_jobs = 2
+maintain_timeout = 3600
+
+# Number of trashed repositories purged concurrently, and the maximum
+# number of files and directories removed per second (0 for no limit)
+purge_jobs = 4
+purge_rate = 0
+
 # Any additional notice related to your repository manager
 # that you would like to include in the notification emails
 # sent out by your repository manager"
@@ -98,70 +175,974 @@ repositories maintainer instead.
 
 #############################################################
 
+class Timings:
+    """Wall time and call counts of the phases of a command, plus counters.
+
+    Filled in by the timed() decorator, phase() blocks and count() calls
+    throughout the module and reported by --timings.  Updates are locked,
+    since ACL edits and repository creation run on thread pools.
+    """
+
+    def __init__(self):
+        import thread
+        self.lock = thread.allocate_lock()
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                p = self.phases.setdefault(name, [0.0, 0])
+                p[0] += elapsed
+                p[1] += 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self, command):
+        """Returns the timings as a JSON-serializable dict."""
+        return {'command': command, 'time': self.start,
+                'seconds': time.time() - self.start,
+                'phases': dict([(k, {'seconds': v[0], 'calls': v[1]})
+                                for k, v in self.phases.iteritems()]),
+                'counters': dict(self.counters)}
+
+timings = Timings()
+
+def timed(name):
+    """Decorator recording every call of a function as a timings phase."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timings.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
 def random_pwd(size):
     """Returns a random password of length size """
     return ''.join([random.choice(string.letters + string.digits) for i in range(size)])
 
-class HtpasswdFile:
-    """A class for manipulating htpasswd files."""
+def crypt_module():
+    """Returns a crypt module."""
+    # We need a crypt module, but Windows doesn't have one by default.  Try to
+    # find one, and tell the user if we can't.
+    try:
+        import crypt
+    except ImportError:
+        try:
+            import fcrypt as crypt
+        except ImportError:
+            sys.stderr.write("Cannot find a crypt module.  "
+                             "Possibly http://carey.geek.nz/code/python-fcrypt/\n")
+            sys.exit(1)
+    return crypt
+
+@timed('hash')
+def hash_entry(username, password, realm=None):
+    """Returns the htpasswd (or htdigest, if realm is given) entry for a user."""
+    if not realm:
+        return [username, crypt_module().crypt(password, random_pwd(2))]
+    try:
+        from hashlib import md5
+    except ImportError:
+        from md5 import md5
+    return [username, realm, md5(':'.join([username, realm, password])).hexdigest()]
+
+def _hash_record(record):
+    """Pool worker: hashes a (username, password, realm) record."""
+    return hash_entry(*record)
+
+def _reseed():
+    """Pool initializer: forked workers must not share salts."""
+    random.seed()
+
+def thread_map(func, items, jobs):
+    """map() over items on up to jobs threads, keeping the results in order.
+
+    Used instead of multiprocessing's ThreadPool, whose shutdown alone
+    takes up to 0.1s -- more than a small batch of hgrc edits.
+    """
+    items = list(items)
+    jobs = min(jobs, len(items))
+    if jobs <= 1:
+        return map(func, items)
+    import threading
+    results = [None] * len(items)
+    work = iter(enumerate(items))
+    def worker():
+        for i, item in work:
+            results[i] = func(item)
+    threads = [threading.Thread(target=worker) for i in range(jobs)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def in_background(func, *args):
+    """Call func from a detached process, so the caller never waits."""
+    if not hasattr(os, 'fork'):
+        return func(*args)
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    # Double fork, so the worker is reparented to init
+    try:
+        os.setsid()
+        if os.fork() == 0:
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            func(*args)
+    finally:
+        os._exit(0)
+
+class RateLimit:
+    """Spaces out calls to wait(), across threads, to rate per second."""
+
+    def __init__(self, rate):
+        import threading
+        self.interval = rate and 1.0 / rate or 0
+        self.next = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+class FileLock:
+    """An exclusive writer lock on '<filename>.lock'.
+
+    Only writers take the lock; readers never block because files are
+    either replaced atomically or appended to.  Without blocking, the
+    lock is not waited for, and locked is False if another process
+    holds it.
+    """
+
+    def __init__(self, filename, blocking=True):
+        self.filename = filename + '.lock'
+        self.blocking = blocking
+        self.fd = None
+        self.locked = False
+
+    def __enter__(self):
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0644)
+        self.locked = True
+        if fcntl:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | (not self.blocking and fcntl.LOCK_NB or 0))
+            except IOError, e:
+                import errno
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    os.close(self.fd)
+                    raise
+                self.locked = False
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl and self.locked:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+        self.locked = False
+
+def file_stat(filename):
+    """Returns an (inode, mtime, size) signature of a file, or None."""
+    timings.count('files stat\'ed')
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime, st.st_size)
+
+def sync_file(fd, filename):
+    """fsync a file just written, or leave it to the active journal."""
+    if active_journal:
+        active_journal.touched.add(os.path.abspath(filename))
+    else:
+        os.fsync(fd)
+        timings.count('fsyncs')
+
+def flush_files(filenames):
+    """Make a batch of files written without fsync durable.
+
+    On Linux this is a single syncfs() per filesystem; elsewhere each
+    file and its directory are fsync'ed.
+    """
+    try:
+        import ctypes
+        syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        syncfs = None
+    if syncfs:
+        devices = {}
+        for f in filenames:
+            try:
+                devices.setdefault(os.stat(f).st_dev, f)
+            except OSError:
+                pass
+        filenames = devices.values()
+    else:
+        filenames = set(filenames) | set(os.path.dirname(f) for f in filenames)
+    for f in filenames:
+        try:
+            fd = os.open(f, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            if not syncfs or syncfs(fd) != 0:
+                os.fsync(fd)
+            timings.count('fsyncs')
+        finally:
+            os.close(fd)
+
+def atomic_write(filename, data, mode=None):
+    """Replace filename with data through a temp file and a rename.
+
+    The new file keeps the owner, group and permissions of the one it
+    replaces (unless a mode is given), so that e.g. a users file or an
+    hgrc stays readable by the web server's group.
+    """
+    import tempfile
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.',
+                               dir=dirname)
+    try:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            st = None
+        if st is not None:
+            try:
+                os.fchown(fd, st.st_uid, st.st_gid)
+            except OSError, e:
+                sys.stderr.write("Warning: cannot keep the owner of %s: %s\n" % (
+                    filename, e.strerror))
+        if mode is None:
+            if st is not None:
+                mode = st.st_mode & 07777
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                mode = 0666 & ~umask
+        os.fchmod(fd, mode)
+        f = os.fdopen(fd, 'wb')
+        f.write(data)
+        timings.count('bytes written', len(data))
+        f.flush()
+        sync_file(f.fileno(), filename)
+        f.close()
+        os.rename(tmp, filename)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+def private_dir(path):
+    """Create a directory only its owner can access, or restrict an
+    existing one to its owner."""
+    if not os.path.isdir(path):
+        os.makedirs(path, 0700)
+    elif os.stat(path).st_mode & 077:
+        os.chmod(path, 0700)
+
+class Journal:
+    """A write-ahead log of operations that change several files.
+
+    begin() appends the whole plan of an operation as one JSON line and
+    fsyncs the journal once.  Files written while the operation is
+    active skip their own fsync; end() flushes them together and marks
+    the operation done.  Operations begun but never ended are returned
+    by pending(), for the 'recover' command to finish or undo.  The
+    journal is emptied whenever nothing is unfinished.
+
+    The process running an operation holds a lock on a file named after
+    it until the operation ends or is suspended, so that operations
+    still in progress in other processes are not taken for crashed ones.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.touched = set()
+        self.lock = None
+
+    def read(self):
+        """Returns the records in the journal."""
+        try:
+            lines = open(self.filename).readlines()
+        except IOError:
+            return []
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # A record torn by a crash; its operation never started
+                pass
+        return records
+
+    def unfinished(self):
+        """Returns an {id: record} dict of the operations not yet ended,
+        including those still in progress."""
+        ops = OrderedDict()
+        for rec in self.read():
+            if 'plan' in rec:
+                ops[rec['id']] = rec
+            else:
+                ops.pop(rec['id'], None)
+        return ops
+
+    def pending(self):
+        """Returns an {id: record} dict of the operations left unfinished,
+        by a crash or a failure, that no process is running."""
+        ops = self.unfinished()
+        for id in ops.keys():
+            if self.running(id):
+                del ops[id]
+        return ops
+
+    def lock_name(self, id):
+        return '%s.%s' % (self.filename, id)
+
+    def running(self, id):
+        """Returns True if a process holds the lock of an operation."""
+        if not fcntl:
+            return False
+        try:
+            fd = os.open(FileLock(self.lock_name(id)).filename, os.O_RDWR)
+        except OSError:
+            # Ended since the journal was read, or logged by a version
+            # that did not lock operations
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def append(self, rec):
+        with FileLock(self.filename):
+            # Plans may hold password hashes
+            fd = os.open(self.filename, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0600)
+            try:
+                if os.fstat(fd).st_mode & 077:
+                    os.fchmod(fd, 0600)
+                data = json.dumps(rec) + '\n'
+                # Start on a fresh line after a torn record
+                if os.fstat(fd).st_size:
+                    os.lseek(fd, -1, os.SEEK_END)
+                    if os.read(fd, 1) != '\n':
+                        data = '\n' + data
+                os.write(fd, data)
+                os.fsync(fd)
+                timings.count('fsyncs')
+                if 'end' in rec and not self.unfinished():
+                    os.ftruncate(fd, 0)
+            finally:
+                os.close(fd)
+
+    def begin(self, op, plan):
+        """Log an operation and make it the active one.  Returns its id."""
+        id = '%d.%d' % (time.time() * 1000000, os.getpid())
+        # Locked before it is logged, so it is never seen unlocked
+        self.resume(id)
+        try:
+            self.append({'id': id, 'op': op, 'plan': plan, 'time': time.time()})
+        except:
+            self.flush()
+            self.release(remove=True)
+            raise
+        return id
+
+    def resume(self, id):
+        """Make a logged operation the active one.  Returns False if
+        another process is running it."""
+        global active_journal
+        lock = FileLock(self.lock_name(id), blocking=False)
+        lock.__enter__()
+        if not lock.locked:
+            lock.__exit__()
+            return False
+        self.lock = lock
+        self.touched = set()
+        active_journal = self
+        return True
+
+    def flush(self):
+        """Flush the files the active operation wrote."""
+        global active_journal
+        active_journal = None
+        with timings.phase('flush'):
+            flush_files(self.touched)
+        self.touched = set()
+
+    def release(self, remove=False):
+        if self.lock is not None:
+            if remove:
+                os.unlink(self.lock.filename)
+            self.lock.__exit__()
+            self.lock = None
+
+    def suspend(self):
+        """Flush the files the active operation wrote, leaving it pending."""
+        self.flush()
+        self.release()
+
+    def end(self, id, state='done'):
+        """Flush the files the active operation wrote and mark it done."""
+        self.flush()
+        self.append({'id': id, 'end': state})
+        self.release(remove=True)
+
+# The journal of the operation in progress, if any
+active_journal = None
+
+def open_journal(config_file):
+    """Returns the journal kept next to config_file, warning about any
+    operations left unfinished."""
+    configdir = os.path.dirname(os.path.abspath(config_file))
+    journal = Journal(os.path.join(configdir, journal_file))
+    pending = journal.pending()
+    if pending:
+        sys.stderr.write("Warning: %d unfinished operations in %s; run 'recover'.\n" % (
+            len(pending), journal.filename))
+    return journal
+
+class UserStore:
+    """Base class of the users file backends.
+
+    Entries are lists of [username, hash] (htpasswd) or [username, realm,
+    hash] (htdigest).  Backends implement get(), set(), delete(), list(),
+    users(), __contains__(), load() and save(), and have filename and
+    stat attributes; stat is the backing_stat() as of the last load.
+    """
+
+    def backing_stat(self):
+        """Returns the signature of the files the users are stored in."""
+        return file_stat(self.filename)
+
+    def changed(self):
+        """Returns True if another process changed the users since load()."""
+        return self.backing_stat() != self.stat
+
+    def entry_realm(self, username, realm=None):
+        """Returns the realm to hash a user's password with.
+
+        Existing entries keep their format: htpasswd entries have no
+        realm, htdigest entries keep theirs unless a new one is given.
+        """
+        entry = self.get(username)
+        if entry:
+            if len(entry) == 2:
+                return None
+            return realm or entry[1]
+        return realm
+
+    def update(self, username, password, realm=None):
+        """Replace the entry for the given user, or add it if new."""
+        self.set(hash_entry(username, password,
+                            self.entry_realm(username, realm)))
+
+class HtpasswdFile(UserStore):
+    """A class for manipulating htpasswd files.
+
+    Entries are kept in an insertion-ordered dict keyed by username, so
+    lookups, updates and deletes are constant time while the on-disk
+    order is preserved.
+
+    Changes are tracked until save(): new users are appended to the file
+    in place, while updates and deletes compact it into a temp file that
+    is renamed over the original.  Saving holds a FileLock and merges in
+    any changes another writer made since the file was loaded.
+    """
 
     def __init__(self, filename, create=False):
-        self.entries = []
+        self.entries = OrderedDict()
+        self.duplicates = set()
         self.filename = filename
+        self.stat = None
+        self.changes = OrderedDict()
+        self.added = OrderedDict()
+        self.compact = False
         if not create:
             if os.path.exists(self.filename):
                 self.load()
             else:
                 raise Exception("%s does not exist" % self.filename)
 
+    @timed('users load')
     def load(self):
         """Read the htpasswd file into memory."""
-        lines = open(self.filename, 'r').readlines()
-        self.entries = []
-        for line in lines:
+        f = open(self.filename, 'r')
+        st = os.fstat(f.fileno())
+        lines = f.readlines()
+        f.close()
+        timings.count('bytes read', st.st_size)
+        self.entries = OrderedDict()
+        self.duplicates = set()
+        for n, line in enumerate(lines):
             e = line.split(':')
             entry = map(lambda x: x.strip(), e)
-            self.entries.append(entry)
+            if not entry[0] or entry[0] in self.entries:
+                # Apache uses the first line for a user; later duplicates
+                # and blank lines are kept under a line-number key only so
+                # that save() writes them back unchanged.
+                self.entries[(n,)] = entry
+                self.duplicates.add(entry[0])
+            else:
+                self.entries[entry[0]] = entry
+        self.stat = (st.st_ino, st.st_mtime, st.st_size)
+        self.changes = OrderedDict()
+        self.added = OrderedDict()
+        self.compact = bool(lines) and not lines[-1].endswith('\n')
+
+    def reload(self):
+        """Re-read the file from disk, keeping the unsaved changes."""
+        changes = self.changes
+        self.load()
+        for username, entry in changes.iteritems():
+            if entry is None:
+                self.delete(username)
+            else:
+                self.set(entry)
 
     def list(self):
         """List the entries in the htpasswd file."""
-        return self.entries
+        return [entry for key, entry in self.entries.iteritems()
+                if not isinstance(key, tuple)]
 
+    def users(self):
+        """Iterate over the usernames in the htpasswd file, in file order."""
+        return (key for key in self.entries if not isinstance(key, tuple))
+
+    def get(self, username):
+        """Returns the entry of a user, or None."""
+        return self.entries.get(username)
+
+    def __contains__(self, username):
+        return username in self.entries
+
+    @timed('users save')
     def save(self):
         """Write the htpasswd file to disk"""
-        open(self.filename, 'w').writelines([":".join(entry) + "\n"
-                                             for entry in self.entries])
+        with FileLock(self.filename):
+            if self.stat is not None and file_stat(self.filename) != self.stat:
+                self.reload()
+
+            if self.compact or self.stat is None:
+                atomic_write(self.filename,
+                             "".join([":".join(entry) + "\n"
+                                      for entry in self.entries.itervalues()]))
+            elif self.added:
+                fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND)
+                try:
+                    data = "".join([":".join(entry) + "\n"
+                                    for entry in self.added.itervalues()])
+                    os.write(fd, data)
+                    timings.count('bytes written', len(data))
+                    sync_file(fd, self.filename)
+                finally:
+                    os.close(fd)
+
+            self.stat = file_stat(self.filename)
+            self.changes = OrderedDict()
+            self.added = OrderedDict()
+            self.compact = False
+
+    def set(self, entry):
+        """Store a pre-hashed entry, replacing any entry for the same user."""
+        username = entry[0]
+        if username in self.added or username not in self.entries:
+            self.added[username] = entry
+        else:
+            self.compact = True
+        self.entries[username] = entry
+        self.changes[username] = entry
 
-    def update(self, username, password, realm=None):
-        """Replace the entry for the given user, or add it if new."""
-        kd = lambda x: md5(':'.join(x)).hexdigest()
-        matching_entries = [entry for entry in self.entries
-                            if entry[0] == username]
-        if matching_entries:
-            if len(matching_entries[0]) == 2:
-                pwhash = crypt.crypt(password, random_pwd(2))
-                matching_entries[0][1] = pwhash
-            else:
-                pwhash = kd([username, realm, password])
-                matching_entries[0][1] = realm
-                matching_entries[0][2] = pwhash
+    def delete(self, username):
+        """Remove the entry for the given user."""
+        if username in self.added:
+            del self.added[username]
+        elif username in self.entries:
+            self.compact = True
+        self.entries.pop(username, None)
+        if username in self.duplicates:
+            for key, entry in self.entries.items():
+                if isinstance(key, tuple) and entry[0] == username:
+                    del self.entries[key]
+            self.duplicates.discard(username)
+            self.compact = True
+        self.changes[username] = None
+
+class DbmUserFile(UserStore):
+    """A users database in a DBM file, as read by Apache's AuthDBMUserFile.
+
+    htpasswd entries are keyed by username and htdigest entries by
+    'username:realm', with the hash as the value, as mod_authn_dbm looks
+    them up.  A digest user also has a 'username:' record holding its
+    realm, which Apache never reads (realms cannot be empty), so a lookup
+    or an update touches a few records rather than the whole database.
+    The database is opened read-only until the first change, which takes
+    the FileLock until save().
+    """
+
+    def __init__(self, filename, create=False):
+        import whichdb
+        self.filename = filename
+        self.db = None
+        self.lock = None
+        self.stat = None
+        if not create and not whichdb.whichdb(filename):
+            raise Exception("%s does not exist" % self.filename)
+
+    def backing_stat(self):
+        # Depending on the DBM module, the data is in filename itself or
+        # in files named after it
+        return tuple(file_stat(self.filename + ext)
+                     for ext in ('', '.db', '.dir', '.pag', '.dat'))
+
+    def open(self, write=False):
+        import anydbm
+        if write and self.lock is None:
+            if self.db is not None:
+                self.db.close()
+            self.lock = FileLock(self.filename)
+            self.lock.__enter__()
+            self.db = anydbm.open(self.filename, 'c')
+        elif self.db is None:
+            self.stat = self.backing_stat()
+            self.db = anydbm.open(self.filename, 'r')
+        return self.db
+
+    def load(self):
+        """Reopen the database, which a read handle may not see changed."""
+        if self.lock is None and self.db is not None:
+            self.db.close()
+            self.db = None
+        self.stat = self.backing_stat()
+
+    def get(self, username):
+        """Returns the entry of a user, or None."""
+        db = self.open()
+        if db.has_key(username):
+            # Databases written before digest entries were keyed by realm
+            # hold 'realm:hash' here
+            return [username] + db[username].split(':')
+        if db.has_key(username + ':'):
+            realm = db[username + ':']
+            key = username + ':' + realm
+            if db.has_key(key):
+                return [username, realm, db[key]]
+        return None
+
+    def __contains__(self, username):
+        return self.get(username) is not None
+
+    def list(self):
+        """List the entries in the database."""
+        return filter(None, [self.get(u) for u in self.users()])
+
+    def users(self):
+        users = []
+        for k in self.open().keys():
+            if ':' not in k:
+                users.append(k)
+            elif k.endswith(':') and k.count(':') == 1:
+                users.append(k[:-1])
+        return users
+
+    def set(self, entry):
+        """Store a pre-hashed entry, replacing any entry for the same user."""
+        self.delete(entry[0])
+        db = self.open(write=True)
+        if len(entry) == 2:
+            db[entry[0]] = entry[1]
         else:
-            if not realm:
-                pwhash = crypt.crypt(password, random_pwd(2))
-                self.entries.append([username, pwhash])
-            else:
-                pwhash = kd([username, realm, password])
-                self.entries.append([username, realm, pwhash])
+            username, realm, pwhash = entry
+            db[username + ':' + realm] = pwhash
+            db[username + ':'] = realm
+
+    def delete(self, username):
+        """Remove the entry for the given user."""
+        db = self.open(write=True)
+        keys = [username]
+        if db.has_key(username + ':'):
+            keys += [username + ':', username + ':' + db[username + ':']]
+        for key in keys:
+            if db.has_key(key):
+                del db[key]
+
+    @timed('users save')
+    def save(self):
+        """Flush the changes to disk and release the writer lock."""
+        if self.lock is not None:
+            self.db.close()
+            self.db = None
+            self.lock.__exit__()
+            self.lock = None
+
+class SqliteUserFile(UserStore):
+    """A users database in SQLite, with one indexed row per user.
+
+    Rows keep their insertion order, so the database can be exported
+    back to the same flat file.
+    """
+
+    def __init__(self, filename, create=False):
+        import sqlite3
+        self.filename = filename
+        if not create and not os.path.exists(filename):
+            raise Exception("%s does not exist" % self.filename)
+        self.db = sqlite3.connect(filename, timeout=30)
+        self.db.execute("CREATE TABLE IF NOT EXISTS users ("
+                        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "username TEXT UNIQUE NOT NULL, realm TEXT, "
+                        "hash TEXT NOT NULL)")
+        self.stat = self.backing_stat()
+
+    def backing_stat(self):
+        return (file_stat(self.filename), file_stat(self.filename + '-wal'))
+
+    def load(self):
+        # Rows are read from disk on every lookup; only the stat that
+        # tells callers to drop what they derived from them is updated
+        self.stat = self.backing_stat()
+
+    @staticmethod
+    def entry(row):
+        username, realm, pwhash = [str(x) if x is not None else None for x in row]
+        if realm is None:
+            return [username, pwhash]
+        return [username, realm, pwhash]
+
+    def get(self, username):
+        """Returns the entry of a user, or None."""
+        row = self.db.execute("SELECT username, realm, hash FROM users "
+                              "WHERE username = ?", (username,)).fetchone()
+        return row and self.entry(row)
+
+    def __contains__(self, username):
+        return self.db.execute("SELECT 1 FROM users WHERE username = ?",
+                               (username,)).fetchone() is not None
+
+    def list(self):
+        """List the entries in the database, in insertion order."""
+        return [self.entry(row) for row in self.db.execute(
+            "SELECT username, realm, hash FROM users ORDER BY id")]
+
+    def users(self):
+        return (str(row[0]) for row in self.db.execute(
+            "SELECT username FROM users ORDER BY id"))
+
+    def set(self, entry):
+        """Store a pre-hashed entry, replacing any entry for the same user."""
+        if len(entry) == 2:
+            username, realm, pwhash = entry[0], None, entry[1]
+        else:
+            username, realm, pwhash = entry
+        cur = self.db.execute("UPDATE users SET realm = ?, hash = ? WHERE username = ?",
+                              (realm, pwhash, username))
+        if not cur.rowcount:
+            self.db.execute("INSERT INTO users (username, realm, hash) VALUES (?, ?, ?)",
+                            (username, realm, pwhash))
 
     def delete(self, username):
         """Remove the entry for the given user."""
-        self.entries = [entry for entry in self.entries
-                        if entry[0] != username]
+        self.db.execute("DELETE FROM users WHERE username = ?", (username,))
+
+    @timed('users save')
+    def save(self):
+        """Commit the changes."""
+        self.db.commit()
+
+def open_users_file(filename, create=False):
+    """Returns the backend for a users file, chosen by its extension."""
+    ext = os.path.splitext(filename)[1]
+    if ext in sqlite_extensions:
+        return SqliteUserFile(filename, create)
+    if ext in dbm_extensions:
+        return DbmUserFile(filename, create)
+    return HtpasswdFile(filename, create)
+
+class MailQueue:
+    """An on-disk spool of outgoing notification emails.
+
+    put() only writes the message to the spool.  flush() delivers the
+    messages that are due, reusing one SMTP session for up to smtp_batch
+    messages.  A failed delivery is retried with exponential backoff
+    and, after smtp_retries attempts, moved to the 'failed' subdirectory,
+    where it is purged after smtp_failed_keep seconds.
+
+    Messages carry plaintext passwords, so the spool and its files are
+    only accessible to their owner.
+    """
+
+    def __init__(self, spooldir, host=None, port=None):
+        self.spooldir = spooldir
+        self.host = host or smtp_host
+        self.port = port or smtp_port
+
+    def put(self, sender, recipient, msg):
+        """Spool a message for delivery."""
+        private_dir(self.spooldir)
+        name = '%.6f-%d-%s.json' % (time.time(), os.getpid(), random_pwd(6))
+        atomic_write(os.path.join(self.spooldir, name),
+                     json.dumps({'from': sender, 'to': recipient, 'msg': msg,
+                                 'attempts': 0, 'due': 0, 'error': None}),
+                     mode=0600)
+        return name
+
+    def list(self):
+        """Returns the (name, record) pairs of the spooled messages."""
+        try:
+            names = sorted([n for n in os.listdir(self.spooldir)
+                            if n.endswith('.json')])
+        except OSError:
+            return []
+        messages = []
+        for name in names:
+            try:
+                messages.append((name, json.load(open(os.path.join(self.spooldir, name)))))
+            except (IOError, ValueError):
+                # Delivered by a concurrent flush, or not a message at all
+                pass
+        return messages
+
+    def flush(self, wait=False):
+        """Deliver the spooled messages that are due.
+
+        With wait, keep retrying deferred messages until the spool is
+        empty.  Without, leave the spool to any other flush in progress.
+        The flush lock is not held while waiting for a retry, so callers
+        never wait on another flush's backoff.  Returns the number of
+        messages sent and given up on.
+        """
+        sent = failed = 0
+        if not os.path.isdir(self.spooldir):
+            return sent, failed
+        while True:
+            with FileLock(os.path.join(self.spooldir, 'flush'), blocking=wait) as lock:
+                if not lock.locked:
+                    break
+                now = time.time()
+                messages = self.list()
+                due = [(n, m) for n, m in messages if m['due'] <= now]
+                if due:
+                    s, f = self.deliver(due)
+                    sent += s
+                    failed += f
+                    continue
+                self.purge_failed()
+                if not wait or not messages:
+                    break
+                delay = max(0, min([m['due'] for n, m in messages]) - now)
+            time.sleep(delay)
+        return sent, failed
+
+    def purge_failed(self):
+        """Remove the given up messages older than smtp_failed_keep."""
+        faileddir = os.path.join(self.spooldir, 'failed')
+        try:
+            names = os.listdir(faileddir)
+        except OSError:
+            return
+        expired = time.time() - smtp_failed_keep
+        for name in names:
+            path = os.path.join(faileddir, name)
+            try:
+                if os.stat(path).st_mtime < expired:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+    @timed('smtp')
+    def deliver(self, messages):
+        """Send (name, record) messages.  Returns the number sent and failed."""
+        import smtplib
+        import socket
+        sent = failed = 0
+        smtp = None
+        count = 0
+        for name, rec in messages:
+            path = os.path.join(self.spooldir, name)
+            if smtp is not None and count >= smtp_batch:
+                self.quit(smtp)
+                smtp = None
+            try:
+                if smtp is None:
+                    smtp = smtplib.SMTP(self.host, self.port, timeout=smtp_timeout)
+                    count = 0
+                count += 1
+                smtp.sendmail(rec['from'], rec['to'], rec['msg'])
+                os.unlink(path)
+                sent += 1
+                timings.count('emails sent')
+            except (smtplib.SMTPException, socket.error), e:
+                # Only a refused recipient leaves the session usable
+                if smtp is not None and not isinstance(e, smtplib.SMTPRecipientsRefused):
+                    smtp.close()
+                    smtp = None
+                if self.defer(name, rec, e):
+                    failed += 1
+        if smtp is not None:
+            self.quit(smtp)
+        return sent, failed
+
+    @staticmethod
+    def quit(smtp):
+        """End an SMTP session, ignoring a server that already went away."""
+        import smtplib
+        import socket
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, socket.error):
+            smtp.close()
+
+    def defer(self, name, rec, error):
+        """Reschedule a failed message.  Returns True if it was given up on."""
+        rec['attempts'] += 1
+        rec['error'] = str(error)
+        path = os.path.join(self.spooldir, name)
+        if rec['attempts'] >= smtp_retries:
+            faileddir = os.path.join(self.spooldir, 'failed')
+            private_dir(faileddir)
+            atomic_write(path, json.dumps(rec), mode=0600)
+            os.rename(path, os.path.join(faileddir, name))
+            return True
+        rec['due'] = time.time() + smtp_backoff * 2 ** (rec['attempts'] - 1)
+        atomic_write(path, json.dumps(rec), mode=0600)
+        return False
+
+    def flush_in_background(self):
+        """Flush the spool from a detached process, so callers never wait."""
+        in_background(self.flush, True)
 
 class User:
     """ A class for managing the users """
     def __init__(self, filename):
-        self.htfile = HtpasswdFile(filename)
+        self.htfile = open_users_file(filename)
+        self.mailq = MailQueue(os.path.join(os.path.dirname(os.path.abspath(filename)),
+                                            mail_spool_dir))
 
     def add(self, username, password=None, realm=None, email=False):
         if not password:
@@ -171,8 +1152,49 @@ class User:
         if email:
             self.notify_user(username, password, email)
 
+    def add_many(self, records, jobs=None, overwrite=False):
+        """Add (username, realm, email, password) records in a single pass.
+
+        Passwords are hashed on a pool of jobs processes and the users
+        file is saved once.  Returns a list of (username, password, email,
+        status) tuples, where status is 'added', 'updated' or 'exists'.
+        """
+        results = []
+        pending = []
+        for username, realm, email, password in records:
+            if username in self.htfile and not overwrite:
+                results.append((username, None, email, 'exists'))
+                continue
+            if not password:
+                password = random_pwd(8)
+            status = 'updated' if username in self.htfile else 'added'
+            results.append((username, password, email, status))
+            pending.append((username, password,
+                            self.htfile.entry_realm(username, realm)))
+
+        if len(pending) > 1 and jobs != 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(jobs, _reseed)
+            try:
+                with timings.phase('hash'):
+                    entries = pool.map(_hash_record, pending, chunksize=64)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            entries = map(_hash_record, pending)
+
+        for entry in entries:
+            self.htfile.set(entry)
+        if entries:
+            self.htfile.save()
+        return results
+
     def list(self):
-        return set([x[0] for x in self.htfile.list()])
+        return self.htfile.users()
+
+    def __contains__(self, username):
+        return username in self.htfile
 
     def delete(self, username):
         self.htfile.delete(username)
@@ -193,45 +1215,795 @@ Mercurial Repository Manager
 %s
 """ % (username, repo_http_url, username, password, repo_usage)
 
+        from email.mime.text import MIMEText
         msg = MIMEText(body)
         msg['Subject'] = "Your password for mercurial repository at %s" % repo_http_url
         msg['From'] = repo_maintainer
         msg['To'] = email
 
-        # Send the email
-        s = smtplib.SMTP('localhost')
-        s.sendmail(repo_maintainer, email, msg.as_string())
-        s.quit()
+        # Spool the email; it is sent by mailq.flush()
+        self.mailq.put(repo_maintainer, email, msg.as_string())
+
+def split_users(val):
+    """Returns the set of usernames in a comma-separated ACL value."""
+    return set([x.strip() for x in val.split(',') if x.strip()])
+
+def acl_allows(rec, username, mode='read'):
+    """Returns True if an AclIndex record lets username read (or push).
+
+    Follows hgweb: a missing or '*' allow_read lets everyone read, while
+    pushing needs read access and a matching allow_push.
+    """
+    read = rec['read']
+    if read not in (None, '*') and username not in split_users(read):
+        return False
+    if mode == 'push':
+        push = rec['push']
+        return push == '*' or (push is not None and username in split_users(push))
+    return True
+
+class AclIndex:
+    """A persistent index of the [web] ACLs of all repositories.
+
+    Each repository's record holds its raw allow_read/allow_push values
+    and is invalidated by the stat signature of its .hg/hgrc, so only
+    hgrc files that changed since the last run are parsed again.  The
+    inverse user -> repositories map is rebuilt from the records and
+    kept current as they change.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.repos = {}
+        self.byuser = None
+        self.wildcard = None
+        self.dirty = False
+        try:
+            with timings.phase('index load'):
+                self.repos = json.load(open(filename))
+        except (IOError, ValueError):
+            pass
+
+    @staticmethod
+    def record(path, config):
+        """Returns the index record of a repository's parsed hgrc."""
+        st = file_stat(os.path.join(path, '.hg', 'hgrc'))
+        rec = {'path': path, 'stat': st and list(st), 'web': False,
+               'read': None, 'push': None}
+        if config.has_section('web'):
+            rec['web'] = True
+            if config.has_option('web', 'allow_read'):
+                rec['read'] = config.get('web', 'allow_read')
+            if config.has_option('web', 'allow_push'):
+                rec['push'] = config.get('web', 'allow_push')
+        return rec
+
+    @staticmethod
+    def members(rec):
+        """Returns (usernames, wildcard) for the users named by a record."""
+        if not rec['web']:
+            return set(), False
+        users = set()
+        wildcard = rec['read'] in (None, '*') or rec['push'] == '*'
+        for val in (rec['read'], rec['push']):
+            if val not in (None, '*'):
+                users |= split_users(val)
+        return users, wildcard
+
+    def _link(self, name, rec, add=True):
+        users, wildcard = self.members(rec)
+        for u in users:
+            if add:
+                self.byuser.setdefault(u, set()).add(name)
+            else:
+                self.byuser[u].discard(name)
+        if wildcard:
+            if add:
+                self.wildcard.add(name)
+            else:
+                self.wildcard.discard(name)
+
+    def put(self, name, rec):
+        """Store the record of a repository."""
+        if self.byuser is not None:
+            if name in self.repos:
+                self._link(name, self.repos[name], add=False)
+            self._link(name, rec)
+        self.repos[name] = rec
+        self.dirty = True
+
+    def remove(self, name):
+        """Drop the record of a repository."""
+        if name in self.repos:
+            if self.byuser is not None:
+                self._link(name, self.repos[name], add=False)
+            del self.repos[name]
+            self.dirty = True
+
+    def get(self, name, path):
+        """Returns the up-to-date record of a repository."""
+        rec = self.repos.get(name)
+        st = file_stat(os.path.join(path, '.hg', 'hgrc'))
+        if rec is None or rec['path'] != path or rec['stat'] != (st and list(st)):
+            with timings.phase('hgrc parse'):
+                config = ConfigParser.ConfigParser()
+                config.read(os.path.join(path, '.hg', 'hgrc'))
+                timings.count('hgrc files parsed')
+            rec = self.record(path, config)
+            self.put(name, rec)
+        return rec
+
+    def refresh(self, repos):
+        """Bring the index up to date with a {name: path} dict."""
+        for name in self.repos.keys():
+            if name not in repos:
+                self.remove(name)
+        for name, path in repos.iteritems():
+            self.get(name, path)
+
+    def listbyuser(self, username, repos):
+        """Returns the repositories in repos that username can access."""
+        if self.byuser is None:
+            self.byuser = {}
+            self.wildcard = set()
+            for name, rec in self.repos.iteritems():
+                self._link(name, rec)
+        self.refresh(repos)
+        return self.byuser.get(username, set()) | self.wildcard
+
+    @timed('index save')
+    def save(self):
+        """Write the index to disk, if it changed."""
+        if not self.dirty:
+            return
+        try:
+            atomic_write(self.filename, json.dumps(self.repos))
+            self.dirty = False
+        except (IOError, OSError):
+            # The index is only a cache; an unwritable one is rebuilt later.
+            pass
+
+@timed('discover')
+def scan_collection(root):
+    """Returns the names of the Mercurial repositories directly under root,
+    and the names of the other directories there."""
+    names = []
+    others = []
+    entries = stats = 0
+    if scandir:
+        for entry in scandir(root):
+            entries += 1
+            if entry.is_dir():
+                stats += 1
+                if os.path.isdir(os.path.join(entry.path, '.hg')):
+                    names.append(entry.name)
+                else:
+                    others.append(entry.name)
+    else:
+        for d in os.listdir(root):
+            entries += 1
+            stats += 1
+            path = os.path.join(root, d)
+            if os.path.isdir(path):
+                stats += 1
+                if os.path.isdir(os.path.join(path, '.hg')):
+                    names.append(d)
+                else:
+                    others.append(d)
+    timings.count('directory entries scanned', entries)
+    timings.count('files stat\'ed', stats)
+    return names, others
+
+def promote_repos(root, names, others):
+    """Move the directories in others that have become repositories since
+    they were scanned over to names.  Returns True if any did.
+
+    Creating '<dir>/.hg' does not change the mtime of root, so a scan
+    that ran between a repository's directory and its '.hg' being made
+    would otherwise never see it.
+    """
+    found = []
+    for d in others:
+        timings.count('files stat\'ed')
+        if os.path.isdir(os.path.join(root, d, '.hg')):
+            found.append(d)
+    for d in found:
+        others.remove(d)
+        names.append(d)
+    return bool(found)
+
+def acl_add(config, username, mode='rw'):
+    """Grant username access in a parsed hgrc.  Returns True if it changed."""
+    changed = False
+    if not config.has_section('web'):
+        config.add_section('web')
+        changed = True
+
+    if config.has_option('web', 'allow_read'):
+        val = config.get('web', 'allow_read')
+        if val != '*':
+            config.set('web', 'allow_read', val + ',' + username)
+            changed = True
+
+    if mode == 'rw':
+        if config.has_option('web', 'allow_push'):
+            val = config.get('web', 'allow_push')
+            if val != '*':
+                config.set('web', 'allow_push', val + ',' + username)
+                changed = True
+        else:
+            config.set('web', 'allow_push', username)
+            changed = True
+    return changed
+
+def acl_del(config, username):
+    """Revoke username's access in a parsed hgrc.  Returns True if it changed."""
+    changed = False
+    if config.has_section('web'):
+        for option in ('allow_read', 'allow_push'):
+            if config.has_option('web', option):
+                val = config.get('web', option)
+                if val != '*':
+                    newval = split_users(val) - set([username])
+                    if newval:
+                        config.set('web', option, ", ".join(newval))
+                    else:
+                        config.remove_option('web', option)
+                    changed = True
+    return changed
+
+def acl_apply(config, ops):
+    """Apply a list of (action, username, mode) ACL ops to a parsed hgrc.
+
+    Returns True if it changed.
+    """
+    changed = False
+    for action, username, mode in ops:
+        if action == 'add':
+            changed = acl_add(config, username, mode) or changed
+        else:
+            changed = acl_del(config, username) or changed
+    return changed
+
+def edit_hgrc(hgrc, values, section='web'):
+    """Set, or with a None value remove, options of one section of an hgrc.
+
+    values is a list of (option, value) pairs.  Only the lines of those
+    options are rewritten; other lines, comments included, are kept as
+    they are.  Missing options are added at the end of the section, and
+    a missing section at the end of the file.  The file is replaced with
+    atomic_write(), which keeps its owner, group and mode: hgweb must
+    still be able to read it, or the ACLs it holds stop applying.
+    Returns True if the file changed.
+    """
+    try:
+        data = open(hgrc, 'rb').read()
+    except IOError:
+        data = ''
+    pending = OrderedDict(values)
+    out = []
+    current = None
+    found = False
+    end = None
+    skip = False
+    for line in data.splitlines(True):
+        stripped = line.strip()
+        if skip and stripped and line[0] in ' \t':
+            # Continuation line of a replaced option
+            continue
+        skip = False
+        if stripped.startswith('[') and ']' in stripped:
+            if current == section:
+                end = len(out)
+            current = stripped[1:stripped.index(']')].strip()
+            found = found or current == section
+        elif current == section and stripped and stripped[0] not in '#;':
+            option = stripped.replace(':', '=', 1).split('=', 1)[0].strip().lower()
+            if option in pending:
+                value = pending.pop(option)
+                skip = True
+                if value is not None:
+                    out.append('%s = %s\n' % (option, value))
+                continue
+        out.append(line)
+    if current == section:
+        end = len(out)
+    if out and not out[-1].endswith('\n'):
+        out[-1] += '\n'
+
+    new = ['%s = %s\n' % (option, value)
+           for option, value in pending.iteritems() if value is not None]
+    if not found:
+        if out and out[-1].strip():
+            out.append('\n')
+        out.append('[%s]\n' % section)
+        out.extend(new)
+    elif new:
+        # Keep the blank lines that separate the section from the next one
+        while end > 0 and not out[end - 1].strip():
+            end -= 1
+        out[end:end] = new
+
+    newdata = ''.join(out)
+    if newdata == data:
+        return False
+    atomic_write(hgrc, newdata)
+    return True
+
+def acl_values(config):
+    """Returns the [(option, value)] ACL pairs of a parsed hgrc."""
+    values = []
+    for option in ('allow_read', 'allow_push'):
+        value = None
+        if config.has_option('web', option):
+            value = config.get('web', option)
+        values.append((option, value))
+    return values
+
+@timed('hgrc edit')
+def _edit_hgrc(task):
+    """Pool worker: applies a list of ACL ops to one repository's hgrc.
+
+    Returns (name, record, error); record is the new AclIndex record, or
+    None if the hgrc was left unchanged or could not be written.
+    """
+    name, path, ops = task
+    hgrc = os.path.join(path, '.hg', 'hgrc')
+    try:
+        config = ConfigParser.ConfigParser()
+        config.read(hgrc)
+        timings.count('hgrc files parsed')
+        if not acl_apply(config, ops):
+            return name, None, None
+        edit_hgrc(hgrc, acl_values(config))
+        return name, AclIndex.record(path, config), None
+    except (IOError, OSError, ConfigParser.Error), e:
+        return name, None, str(e)
+
+@timed('hgrc edit')
+def _sync_hgrc(task):
+    """Pool worker: sets ACL options of one repository's hgrc in place.
+
+    Returns (name, error).
+    """
+    name, path, values = task
+    try:
+        edit_hgrc(os.path.join(path, '.hg', 'hgrc'), values)
+        return name, None
+    except (IOError, OSError), e:
+        return name, str(e)
+
+class AclPolicy:
+    """A declarative access policy, read from an INI file.
+
+    Each section names a repository, or a shell pattern matching
+    repositories, and lists its users in 'ro' and 'rw' options; '*'
+    stands for everyone.  A repository's own section takes precedence
+    over patterns, and the first matching pattern wins otherwise.
+    Repositories not matched by any section are left alone.
+    """
+
+    def __init__(self, filename):
+        config = ConfigParser.ConfigParser()
+        if not config.read(filename):
+            raise IOError("Cannot read policy file %s" % filename)
+        self.sections = OrderedDict()
+        for section in config.sections():
+            users = {}
+            for mode in ('ro', 'rw'):
+                users[mode] = set()
+                if config.has_option(section, mode):
+                    users[mode] = split_users(config.get(section, mode))
+            self.sections[section] = users
+
+    def users(self):
+        """Returns all the usernames the policy names."""
+        names = set()
+        for users in self.sections.itervalues():
+            names |= users['ro'] | users['rw']
+        names.discard('*')
+        return names
+
+    def discard(self, usernames):
+        """Drop usernames from every section."""
+        for users in self.sections.itervalues():
+            users['ro'] -= usernames
+            users['rw'] -= usernames
+
+    def lookup(self, name):
+        """Returns the {'ro': users, 'rw': users} of a repository, or None."""
+        if name in self.sections:
+            return self.sections[name]
+        import fnmatch
+        for pattern, users in self.sections.iteritems():
+            if fnmatch.fnmatchcase(name, pattern):
+                return users
+        return None
+
+    @staticmethod
+    def values(users):
+        """Returns the allow_read and allow_push values for a section."""
+        if '*' in users['rw']:
+            return '*', '*'
+        read = users['ro'] | users['rw']
+        if '*' in read:
+            read = '*'
+        else:
+            read = ', '.join(sorted(read)) or None
+        return read, ', '.join(sorted(users['rw'])) or None
+
+def _copy_skeleton(task):
+    """Pool worker: materializes a repository from a skeleton's .hg.
+
+    The hgrc is always copied, since ACL edits rewrite it in place;
+    Mercurial itself breaks hard links before writing to store files.
+    Returns (name, path, error).
+    """
+    name, repo, skel, link = task
+    created = False
+    try:
+        os.makedirs(repo)
+        created = True
+        src = os.path.join(skel, '.hg')
+        for dirpath, dirnames, filenames in os.walk(src):
+            rel = os.path.relpath(dirpath, src)
+            dst = os.path.normpath(os.path.join(repo, '.hg', rel))
+            os.mkdir(dst)
+            shutil.copymode(dirpath, dst)
+            for f in filenames:
+                s = os.path.join(dirpath, f)
+                d = os.path.join(dst, f)
+                if link and not (rel == '.' and f == 'hgrc'):
+                    try:
+                        os.link(s, d)
+                        continue
+                    except OSError:
+                        # e.g. EXDEV for repositories on another filesystem
+                        pass
+                shutil.copy2(s, d)
+        return name, repo, None
+    except (IOError, OSError), e:
+        if created:
+            shutil.rmtree(repo, ignore_errors=True)
+        return name, repo, str(e)
+
+def _changelog(path):
+    """Returns the changelog index of a repository, with or without a store."""
+    changelog = os.path.join(path, '.hg', 'store', '00changelog.i')
+    if not os.path.exists(changelog):
+        changelog = os.path.join(path, '.hg', '00changelog.i')
+    return changelog
+
+def _repo_stats(task):
+    """Pool worker: collects the statistics of one repository.
+
+    Returns (name, record, error); record holds the size of the store in
+    bytes, the number of changesets and the date of the tip.
+    """
+    name, path, key = task
+    try:
+        size = 0
+        store = os.path.join(path, '.hg', 'store')
+        for dirpath, dirnames, filenames in os.walk(store):
+            for f in filenames:
+                size += os.lstat(os.path.join(dirpath, f)).st_size
+        changesets, tip = 0, None
+        if key is not None:
+            from mercurial import ui, hg
+            repo = hg.repository(ui.ui(), path)
+            changesets = len(repo)
+            if changesets:
+                tip = repo['tip'].date()[0]
+        return name, {'path': path, 'key': key, 'size': size,
+                      'changesets': changesets, 'tip': tip}, None
+    except Exception, e:
+        return name, None, str(e)
+
+def purge_tree(path, limit):
+    """Remove a directory tree, pacing each removal with a RateLimit.
+
+    Unlike shutil.rmtree(ignore_errors=True), every failure is kept: the
+    list of error messages is returned.
+    """
+    import errno
+    errors = []
+    def onerror(e):
+        errors.append("%s: %s" % (e.filename, e.strerror))
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False, onerror=onerror):
+        # os.walk lists symlinks to directories with the directories
+        for f in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+            limit.wait()
+            try:
+                os.unlink(os.path.join(dirpath, f))
+            except OSError, e:
+                errors.append("%s: %s" % (os.path.join(dirpath, f), e.strerror))
+        limit.wait()
+        try:
+            os.rmdir(dirpath)
+        except OSError, e:
+            # A directory left non-empty by an earlier error adds nothing
+            if not (errors and e.errno == errno.ENOTEMPTY):
+                errors.append("%s: %s" % (dirpath, e.strerror))
+    timings.count('purge errors', len(errors))
+    return errors
+
+def _purge_entry(task):
+    """Pool worker: purges one trashed repository.
+
+    The errors are also saved next to the entry, so a background purge
+    can report them to a later 'trash list'.  Returns (record, errors).
+    """
+    rec, limit = task
+    errors = purge_tree(rec['entry'], limit)
+    try:
+        if errors:
+            atomic_write(rec['entry'] + '.errors', "".join(e + '\n' for e in errors))
+        else:
+            for f in (rec['entry'] + '.errors', rec['entry'] + '.json'):
+                if os.path.exists(f):
+                    os.unlink(f)
+    except (IOError, OSError):
+        pass
+    return rec, errors
+
+def scan_store(path):
+    """A cheap integrity scan of a repository's store, without Mercurial.
+
+    Looks for an interrupted transaction, unreadable files, truncated
+    revlog indexes and missing revlog data files.  Returns a list of
+    problems.
+    """
+    import struct
+    problems = []
+    hg = os.path.join(path, '.hg')
+    store = os.path.join(hg, 'store')
+    if not os.path.isdir(store):
+        store = hg
+    if os.path.exists(os.path.join(store, 'journal')):
+        problems.append("interrupted transaction (run recover)")
+    def onerror(e):
+        problems.append("%s: %s" % (e.filename, e.strerror))
+    for dirpath, dirnames, filenames in os.walk(store, onerror=onerror):
+        for f in filenames:
+            if not f.endswith('.i'):
+                continue
+            index = os.path.join(dirpath, f)
+            rel = os.path.relpath(index, path)
+            try:
+                with open(index, 'rb') as fp:
+                    header = fp.read(4)
+                size = os.path.getsize(index)
+            except (IOError, OSError), e:
+                problems.append("%s: %s" % (rel, e.strerror))
+                continue
+            if len(header) < 4:
+                if size:
+                    problems.append("%s: truncated header" % rel)
+                continue
+            inline = struct.unpack('>I', header)[0] & (1 << 16)
+            if inline:
+                continue
+            # Non-inline indexes are arrays of 64-byte entries, with the
+            # revision data in a separate .d file
+            if size % 64:
+                problems.append("%s: truncated index" % rel)
+            if not os.path.exists(index[:-2] + '.d'):
+                problems.append("%s.d: missing data file" % rel[:-2])
+    timings.count('repositories scanned')
+    return problems
+
+def maintenance_key(path):
+    """Returns the signature that invalidates a repository's maintenance
+    result: the stat of its changelog and of any transaction journal."""
+    changelog = _changelog(path)
+    return [file_stat(f) and list(file_stat(f))
+            for f in (changelog, os.path.join(os.path.dirname(changelog), 'journal'))]
+
+def _maintain(action, path, conn):
+    """Child process: runs one maintenance action and sends the
+    (status, message) result over conn."""
+    try:
+        if action == 'scan':
+            problems = scan_store(path)
+            result = problems and ('failed', '\n'.join(problems)) or ('ok', '')
+        else:
+            from mercurial import ui, hg
+            hgui = ui.ui()
+            hgui.pushbuffer()
+            repo = hg.repository(hgui, path)
+            status = 'ok'
+            if action == 'recover' and repo.recover():
+                status = 'recovered'
+            if hg.verify(repo):
+                status = 'failed'
+            result = (status, hgui.popbuffer())
+    except Exception, e:
+        result = ('failed', str(e))
+    # Only the tail of a long report is kept
+    conn.send((result[0], result[1][-4096:].strip()))
+    conn.close()
+
+class MaintenanceLog:
+    """The results of 'maintain', one JSON line per checked repository.
+
+    Lines are appended as checks complete, so an interrupted run loses
+    nothing; the last line of a repository wins.  A result is current
+    while the repository's maintenance_key() stays the same.
+    """
+
+    def __init__(self, filename):
+        import threading
+        self.filename = filename
+        self.results = {}
+        self.lock = threading.Lock()
+        try:
+            for line in open(filename):
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                self.results[rec['repo']] = rec
+        except IOError:
+            pass
+
+    def current(self, name, action, key):
+        """Returns True if the repository passed action since it last changed."""
+        rec = self.results.get(name)
+        # A verify also covers a scan, and a recover both
+        covers = {'scan': ('scan', 'verify', 'recover'), 'verify': ('verify', 'recover'),
+                  'recover': ('recover',)}
+        return bool(rec and rec['key'] == key and rec['status'] in ('ok', 'recovered')
+                    and rec['action'] in covers[action])
+
+    def record(self, rec):
+        """Append a result to the log."""
+        with self.lock:
+            self.results[rec['repo']] = rec
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(rec, sort_keys=True) + '\n')
+
+    def compact(self, names):
+        """Rewrite the log with only the latest result of each of names."""
+        atomic_write(self.filename, "".join(
+            json.dumps(self.results[n], sort_keys=True) + '\n'
+            for n in sorted(names) if n in self.results))
+
+def _fork_repo(task):
+    """Pool worker: clones a repository without a working directory.
+
+    Mercurial hard-links the store files of a local clone on the same
+    filesystem.  values, if given, are the [web] ACL options to set in
+    the new hgrc.  Returns (name, path, error).
+    """
+    name, src, dst, values = task
+    created = False
+    try:
+        # Mercurial clones into an empty directory; creating it here
+        # refuses an existing one, which is then never removed
+        os.makedirs(dst)
+        created = True
+        from mercurial import ui, hg
+        hg.clone(ui.ui(), {}, src, dst, update=False)
+        if values:
+            edit_hgrc(os.path.join(dst, '.hg', 'hgrc'), values)
+        return name, dst, None
+    except Exception, e:
+        if created:
+            shutil.rmtree(dst, ignore_errors=True)
+        return name, dst, str(e)
 
 class Repository:
-    """ A class for managing the repositories """
+    """ A class for managing the repositories
+
+    Collections are only scanned when the full list of repositories is
+    needed, and their listings are cached by directory mtime.  Single
+    repositories are resolved with a direct stat of <root>/<name>/.hg.
+    """
     def __init__(self, filename):
-        self.available_repos = {}
+        self._available_repos = None
+        self.scanned = {}
+        self.collections = []
+        self.collection_names = {}
+        self.paths = OrderedDict()
         self.default_root = None
+        configdir = os.path.dirname(os.path.abspath(filename))
+        self.configdir = configdir
+        self.index = AclIndex(os.path.join(configdir, acl_index_file))
+        self.cache_file = os.path.join(configdir, repo_cache_file)
+        self.stats_file = os.path.join(configdir, stats_cache_file)
         config = ConfigParser.ConfigParser()
         config.read(filename)
 
         if config.has_section('collections'):
             collections = config.items('collections')
-            for _, c in collections:
+            for n, c in collections:
                 # Make the first collection you find, a default collection.
                 if not self.default_root:
                     self.default_root = c
-                dirs = os.listdir(c)
-                for d in dirs:
-                    path = os.path.join(os.path.abspath(c), d)
-                    if os.path.isdir(path) and os.path.isdir(os.path.join(path, '.hg')):
-                        self.available_repos[os.path.basename(d)] = path
+                self.collections.append(os.path.abspath(c))
+                self.collection_names[n] = os.path.abspath(c)
 
         if config.has_section('paths'):
             paths = config.items('paths')
             for n, p in paths:
                 if not self.default_root:
                     self.default_root = os.path.dirname(p)
-                self.available_repos[n] = os.path.abspath(p)
-
-
-    def create(self, name):
+                self.paths[n] = os.path.abspath(p)
+
+    @property
+    def available_repos(self):
+        """A {name: path} dict of all repositories, discovered on first use."""
+        if self._available_repos is None:
+            self._available_repos = self.discover()
+        return self._available_repos
+
+    def discover(self):
+        """Scan the collections, skipping those unchanged since the last scan."""
+        try:
+            cache = json.load(open(self.cache_file))
+        except (IOError, ValueError):
+            cache = {}
+
+        repos = {}
+        changed = False
+        for c in self.collections:
+            mtime = os.stat(c).st_mtime
+            timings.count('files stat\'ed')
+            if c in cache and len(cache[c]) == 3 and cache[c][0] == mtime:
+                names, others = cache[c][1:]
+                if promote_repos(c, names, others):
+                    changed = True
+            else:
+                names, others = scan_collection(c)
+                cache[c] = [mtime, names, others]
+                changed = True
+            self.scanned[c] = (mtime, others)
+            for d in names:
+                repos[d] = os.path.join(c, d)
+        repos.update(self.paths)
+
+        if changed:
+            try:
+                atomic_write(self.cache_file, json.dumps(cache))
+            except (IOError, OSError):
+                pass
+        return repos
+
+    def revalidate(self):
+        """Forget the discovered repositories if a collection has changed."""
+        for c, (mtime, others) in self.scanned.iteritems():
+            timings.count('files stat\'ed')
+            try:
+                if (os.stat(c).st_mtime == mtime and
+                    not promote_repos(c, [], list(others))):
+                    continue
+            except OSError:
+                pass
+            self._available_repos = None
+            self.scanned = {}
+            break
+
+    def path(self, name):
+        """Returns the path of a repository, or None if it does not exist."""
+        if self._available_repos is not None:
+            return self._available_repos.get(name)
+        if name in self.paths:
+            return self.paths[name]
+        if os.sep in name or name in ('.', '..'):
+            return None
+        # Later collections take precedence, as they do in discover()
+        for c in reversed(self.collections):
+            path = os.path.join(c, name)
+            timings.count('files stat\'ed')
+            if os.path.isdir(os.path.join(path, '.hg')):
+                return path
+        return None
+
+    def __contains__(self, name):
+        return self.path(name) is not None
+
+    def target(self, name):
+        """Returns the (name, path) a new repository called name is created at."""
         # Check if it's an absolute path
         if os.path.exists(os.path.dirname(name)):
             path = os.path.dirname(name)
@@ -239,148 +2011,895 @@ class Repository:
         else:
             path = self.default_root
             newname = name
-
-        repo = os.path.join(path, newname)
-        if newname not in self.available_repos:
+        return newname, os.path.join(path, newname)
+
+    def create(self, name, existing=False):
+        """Create a repository with hg init.  With existing, an existing
+        directory without a .hg is initialized instead of refused."""
+        newname, repo = self.target(name)
+        if newname not in self:
+            from mercurial import ui, commands
             hgui = ui.ui()
-            os.makedirs(repo)
-            commands.init(hgui, repo)
-            self.available_repos[newname] = repo
+            if not (existing and os.path.isdir(repo)):
+                os.makedirs(repo)
+            with timings.phase('hg init'):
+                commands.init(hgui, repo)
+            if self._available_repos is not None:
+                self._available_repos[newname] = repo
+
+    def create_many(self, names, users=None, jobs=None, link=False):
+        """Create repositories from a skeleton built by a single hg init.
+
+        The skeleton's .hg, including an hgrc granting users read-write
+        access, is copied (or, with link, hard-linked) into each new
+        repository on a pool of jobs threads.  Returns a list of
+        (name, error) tuples, where error is None on success.
+        """
+        tasks = []
+        for name in names:
+            newname, repo = self.target(name)
+            if newname not in self:
+                tasks.append((newname, repo))
+        if not tasks:
+            return []
+
+        import tempfile
+        from mercurial import ui, commands
+        skel = tempfile.mkdtemp(prefix='.hg-manager-skel-', dir=self.skeleton_dir())
+        try:
+            with timings.phase('hg init'):
+                commands.init(ui.ui(), skel)
+            if users:
+                hgrc = os.path.join(skel, '.hg', 'hgrc')
+                config = ConfigParser.ConfigParser()
+                config.read(hgrc)
+                for u in users:
+                    acl_add(config, u)
+                with open(hgrc, 'wb') as f:
+                    config.write(f)
+
+            tasks = [(newname, repo, skel, link) for newname, repo in tasks]
+            results = thread_map(_copy_skeleton, tasks, jobs or create_jobs)
+        finally:
+            shutil.rmtree(skel, ignore_errors=True)
+
+        for newname, repo, error in results:
+            if not error and self._available_repos is not None:
+                self._available_repos[newname] = repo
+        return [(newname, error) for newname, repo, error in results]
+
+    def skeleton_dir(self):
+        """Returns the directory to build a create_many() skeleton in.
+
+        hgweb serves every repository anywhere under a collection, so the
+        skeleton goes next to the configuration file or the default root
+        instead, whichever is outside the collections and on the same
+        filesystem as the default root, so that it can be hard-linked.
+        Otherwise it goes to the temp directory and is copied.
+        """
+        root = os.path.abspath(self.default_root or os.curdir)
+        try:
+            dev = os.stat(root).st_dev
+        except OSError:
+            return None
+        for d in (self.configdir, os.path.dirname(root)):
+            inside = [c for c in self.collections
+                      if d == c or d.startswith(c.rstrip(os.sep) + os.sep)]
+            try:
+                if not inside and os.stat(d).st_dev == dev and os.access(d, os.W_OK):
+                    return d
+            except OSError:
+                pass
+        return None
+
+    def fork(self, src, names, owner=None, copy_acl=True, jobs=None):
+        """Clone src into each of names, on a pool of jobs processes.
+
+        The clones share src's store through hard links.  They get a copy
+        of src's [web] ACLs, unless copy_acl is False, and owner, if
+        given, gets read-write access; an owner alone is given the
+        repository to themselves.  Returns a list of (name, error)
+        tuples, where error is None on success.
+        """
+        tasks = []
+        for name in names:
+            newname, repo = self.target(name)
+            if newname not in self:
+                tasks.append((newname, repo))
+        if not tasks:
+            return []
+
+        acl = self.index.get(src, self.path(src))
+        config = ConfigParser.ConfigParser()
+        if copy_acl and acl['web']:
+            config.add_section('web')
+            for option, key in (('allow_read', 'read'), ('allow_push', 'push')):
+                if acl[key] is not None:
+                    config.set('web', option, acl[key])
+        if owner:
+            if not config.has_section('web'):
+                config.add_section('web')
+                config.set('web', 'allow_read', owner)
+            for option in ('allow_read', 'allow_push'):
+                if not config.has_option('web', option):
+                    if option == 'allow_push':
+                        config.set('web', option, owner)
+                    continue
+                val = config.get('web', option)
+                if val != '*' and owner not in split_users(val):
+                    config.set('web', option, val + ', ' + owner)
+        values = config.has_section('web') and acl_values(config) or None
+
+        tasks = [(newname, self.path(src), repo, values) for newname, repo in tasks]
+        if len(tasks) > 1 and jobs != 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(jobs or create_jobs)
+            try:
+                with timings.phase('hg clone'):
+                    results = pool.map(_fork_repo, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            with timings.phase('hg clone'):
+                results = map(_fork_repo, tasks)
+
+        for newname, repo, error in results:
+            if not error:
+                if self._available_repos is not None:
+                    self._available_repos[newname] = repo
+                self.index.get(newname, repo)
+        return [(newname, error) for newname, repo, error in results]
 
     def delete(self, name):
-        if name in self.available_repos:
-            path = self.available_repos[name]
-            shutil.rmtree(path, ignore_errors=True)
-            del self.available_repos[name]
+        """Move a repository to the trash; returns its trash entry.
+
+        Renaming its '.hg' makes the repository disappear from hgweb at
+        once; the directory is then moved to the trash, with its name and
+        original path recorded in '<entry>.json', and purge() removes the
+        data later.
+        """
+        path = self.path(name)
+        if path:
+            trash = os.path.join(os.path.dirname(path), trash_dir)
+            if not os.path.isdir(trash):
+                os.mkdir(trash)
+            base = os.path.basename(path)
+            stamp = int(time.time())
+            while os.path.exists(os.path.join(trash, '%s.%d' % (base, stamp))):
+                stamp += 1
+            entry = os.path.join(trash, '%s.%d' % (base, stamp))
+            atomic_write(entry + '.json', json.dumps({'name': name, 'path': path}))
+            os.rename(os.path.join(path, '.hg'), os.path.join(path, trashed_hg_dir))
+            try:
+                os.rename(path, entry)
+            except OSError:
+                os.rename(os.path.join(path, trashed_hg_dir), os.path.join(path, '.hg'))
+                os.unlink(entry + '.json')
+                raise
+            if self._available_repos is not None:
+                del self._available_repos[name]
+            self.paths.pop(name, None)
+            self.index.remove(name)
+            return entry
+
+    def trash(self):
+        """Returns the trashed repositories, oldest first.
+
+        Each is a dict with the repository's name, original path, trash
+        entry, deletion time and the errors of the last purge, if any.
+        """
+        roots = set(self.collections)
+        roots.update(os.path.dirname(p) for p in self.paths.itervalues())
+        records = []
+        for root in roots:
+            trash = os.path.join(root, trash_dir)
+            if not os.path.isdir(trash):
+                continue
+            for f in os.listdir(trash):
+                entry = os.path.join(trash, f)
+                name, _, stamp = f.rpartition('.')
+                if not stamp.isdigit() or not os.path.isdir(entry):
+                    continue
+                errors = []
+                if os.path.exists(entry + '.errors'):
+                    errors = open(entry + '.errors').read().splitlines()
+                rec = {'name': name, 'path': os.path.join(root, name)}
+                try:
+                    rec.update(json.load(open(entry + '.json')))
+                except (IOError, ValueError):
+                    # Trashed before the original path was recorded
+                    pass
+                rec.update({'entry': entry, 'deleted': int(stamp), 'errors': errors})
+                records.append(rec)
+        records.sort(key=lambda rec: (rec['deleted'], rec['name']))
+        return records
+
+    def restore(self, rec):
+        """Move a trashed repository back into place."""
+        if os.path.exists(rec['path']):
+            raise OSError("%s already exists" % rec['path'])
+        os.rename(rec['entry'], rec['path'])
+        hg = os.path.join(rec['path'], trashed_hg_dir)
+        if os.path.isdir(hg):
+            os.rename(hg, os.path.join(rec['path'], '.hg'))
+        for f in (rec['entry'] + '.errors', rec['entry'] + '.json'):
+            if os.path.exists(f):
+                os.unlink(f)
+        if self._available_repos is not None:
+            self._available_repos[rec['name']] = rec['path']
+
+    def purge(self, records, jobs=None, rate=None):
+        """Remove trashed repositories for good.
+
+        Entries are purged on a pool of jobs threads, which together
+        remove at most rate files and directories per second.  Returns a
+        list of (record, errors) tuples.
+        """
+        limit = RateLimit(purge_rate if rate is None else rate)
+        with timings.phase('purge'):
+            return thread_map(_purge_entry, [(rec, limit) for rec in records],
+                              jobs or purge_jobs)
 
     def list(self):
         return self.available_repos.keys()
 
     def listbyuser(self, username):
-        repos = self.list()
-        myrepos = set()
-        for r in repos:
-            urs = self.listusers(r, [username])
-            for v in urs.values():
-                if username in v:
-                    myrepos.add(r)
-        return myrepos
+        return self.index.listbyuser(username, self.available_repos)
+
+    def match(self, glob=None, regex=None, collections=None):
+        """Returns the sorted names of the repositories matching all of a
+        shell pattern, a regular expression and a list of collections.
+
+        Collections are given by their name in the [collections] section
+        of the configuration file, or by their path.
+        """
+        names = self.available_repos.keys()
+        if glob:
+            import fnmatch
+            names = fnmatch.filter(names, glob)
+        if regex:
+            import re
+            regex = re.compile(regex)
+            names = [n for n in names if regex.search(n)]
+        if collections:
+            roots = set(self.collection_names.get(c) or os.path.abspath(c)
+                        for c in collections)
+            names = [n for n in names
+                     if os.path.dirname(self.available_repos[n]) in roots]
+        return sorted(names)
+
+    def iterusers(self, name, users=()):
+        """Yields the (username, mode) pairs of a repository, ro users first.
+
+        users is an iterable of all usernames, consumed at most once, which
+        stands in for '*' ACLs.
+        """
+        acl = self.index.get(name, self.path(name))
+        if not acl['web']:
+            return
+        read, push = acl['read'], acl['push']
+        if push == '*':
+            for u in users:
+                yield u, 'rw'
+            return
+        if push is None:
+            rw = set()
+        else:
+            rw = split_users(push)
+        if read in (None, '*'):
+            readers = users
+        else:
+            readers = split_users(read)
+        for u in readers:
+            if u not in rw:
+                yield u, 'ro'
+        for u in rw:
+            yield u, 'rw'
+
+    def describe(self, name):
+        """Returns a JSON-serializable description of a repository's ACLs."""
+        path = self.path(name)
+        acl = self.index.get(name, path)
+        read, push = acl['read'], acl['push']
+        rw = push not in (None, '*') and split_users(push) or set()
+        ro = read not in (None, '*') and split_users(read) - rw or set()
+        return {'repo': name, 'path': path, 'ro': sorted(ro), 'rw': sorted(rw),
+                'read_all': acl['web'] and read in (None, '*'),
+                'push_all': acl['web'] and push == '*'}
 
     def listusers(self, name, users=[]):
         u = {}
-        path = self.available_repos[name]
-        config = ConfigParser.ConfigParser()
-        config.read(path + "/.hg/hgrc")
+        acl = self.index.get(name, self.path(name))
         ro_users = set()
         rw_users = set()
-        if config.has_section('web'):
-            if config.has_option('web', 'allow_read'):
-                val = config.get('web', 'allow_read')
-                if val == '*':
-                    ro_users = users
-                else:
-                    ro_users = set(val.split(','))
-            else:
+        if acl['web']:
+            val = acl['read']
+            if val is None or val == '*':
                 ro_users = users
-
-            if config.has_option('web', 'allow_push'):
-                val = config.get('web', 'allow_push')
-                if val == '*':
-                    rw_users = users
-                else:
-                    rw_users = val.split(',')
             else:
-                rw_users = set()
+                ro_users = split_users(val)
+
+            val = acl['push']
+            if val == '*':
+                rw_users = users
+            elif val is not None:
+                rw_users = split_users(val)
 
         u['ro'] = set(ro_users) - set(rw_users)
         u['rw'] = set(rw_users)
         return u
 
-    def adduser(self, name, username, mode='rw'):
-        path = self.available_repos[name]
-        config = ConfigParser.ConfigParser()
-        config.read(os.path.join(path, '.hg/hgrc'))
-        if not config.has_section('web'):
-            config.add_section('web')
-
-        if config.has_option('web', 'allow_read'):
-            val = config.get('web', 'allow_read')
-            if val != '*':
-                config.set('web', 'allow_read', val + ',' + username)
+    def stats(self, names, jobs=None):
+        """Returns a {name: record} dict of repository statistics.
+
+        Records are cached by the stat signature of each repository's
+        changelog, so only repositories that changed since the last run
+        are opened again; those are walked on a pool of jobs processes.
+        Repositories that could not be read are left out.
+        """
+        try:
+            cache = json.load(open(self.stats_file))
+        except (IOError, ValueError):
+            cache = {}
+
+        results = {}
+        tasks = []
+        for name in names:
+            path = self.path(name)
+            st = file_stat(_changelog(path))
+            key = st and list(st)
+            rec = cache.get(name)
+            if rec and rec['path'] == path and rec['key'] == key:
+                results[name] = rec
+            else:
+                tasks.append((name, path, key))
+        timings.count('repositories revisited', len(tasks))
+
+        if len(tasks) > 1 and jobs != 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(jobs)
+            try:
+                with timings.phase('stats'):
+                    done = pool.map(_repo_stats, tasks, chunksize=8)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            done = map(_repo_stats, tasks)
 
-        if mode == 'rw':
-            if config.has_option('web', 'allow_push'):
-                val = config.get('web', 'allow_push')
-                if val != '*':
-                    config.set('web', 'allow_push', val + ',' + username)
+        for name, rec, error in done:
+            if error:
+                sys.stderr.write("Failed to read repository %s: %s\n" % (name, error))
             else:
-                config.set('web', 'allow_push', username)
+                results[name] = cache[name] = rec
+
+        stale = [name for name in cache if name not in self.available_repos]
+        for name in stale:
+            del cache[name]
+        if done or stale:
+            try:
+                atomic_write(self.stats_file, json.dumps(cache))
+            except (IOError, OSError):
+                pass
+        return results
 
-        with open(os.path.join(path, '.hg/hgrc'), 'wb') as hgrc:
-            config.write(hgrc)
+    def adduser(self, name, username, mode='rw'):
+        """Grant username access to a repository.  Returns an error
+        message if its hgrc could not be updated, else None."""
+        return self.apply([(name, 'add', username, mode)], jobs=1)[0][1]
 
     def deluser(self, name, username):
-        path = self.available_repos[name]
-        config = ConfigParser.ConfigParser()
-        config.read(os.path.join(path, '.hg/hgrc'))
-        if config.has_section('web'):
-            if config.has_option('web', 'allow_read'):
-                val = config.get('web', 'allow_read')
-                if val != '*':
-                    newval = set(val.split(',')) - set([username])
-                    if newval:
-                        config.set('web', 'allow_read', ", ".join(newval))
-                    else:
-                        config.remove_option('web', 'allow_read')
-
-            if config.has_option('web', 'allow_push'):
-                val = config.get('web', 'allow_push')
-                if val != '*':
-                    newval = set(val.split(',')) - set([username])
-                    if newval:
-                        config.set('web', 'allow_push', ", ".join(newval))
-                    else:
-                        config.remove_option('web', 'allow_push')
-
-            with open(os.path.join(path, '.hg/hgrc'), 'wb') as hgrc:
-                config.write(hgrc)
-
+        """Revoke username's access to a repository.  Returns an error
+        message if its hgrc could not be updated, else None."""
+        return self.apply([(name, 'del', username, None)], jobs=1)[0][1]
+
+    def apply(self, changes, jobs=None):
+        """Apply a batch of (name, action, username, mode) ACL changes.
+
+        action is 'add' or 'del'.  Changes are grouped per repository so
+        each hgrc is read and written once, and the repositories are
+        edited on a pool of jobs threads.  Returns a list of (name, error)
+        tuples in plan order, where error is None on success.
+        """
+        plan = OrderedDict()
+        for name, action, username, mode in changes:
+            plan.setdefault(name, []).append((action, username, mode))
+        tasks = [(name, self.path(name), ops) for name, ops in plan.iteritems()]
+
+        results = thread_map(_edit_hgrc, tasks, jobs or acl_jobs)
+
+        # The index is not thread-safe, so it is updated from here
+        for name, rec, error in results:
+            if rec:
+                self.index.put(name, rec)
+        return [(name, error) for name, rec, error in results]
+
+    def preview(self, changes):
+        """Returns the diff a batch of ACL changes would make, without
+        touching any hgrc.
+
+        The diff is a list of (name, option, old, new) tuples in plan
+        order, where old or new is None for a missing option.  It is
+        computed from the ACL index, which is kept up to date.
+        """
+        plan = OrderedDict()
+        for name, action, username, mode in changes:
+            plan.setdefault(name, []).append((action, username, mode))
+        diff = []
+        for name, ops in plan.iteritems():
+            acl = self.index.get(name, self.path(name))
+            config = ConfigParser.ConfigParser()
+            if acl['web']:
+                config.add_section('web')
+                for option, key in (('allow_read', 'read'), ('allow_push', 'push')):
+                    if acl[key] is not None:
+                        config.set('web', option, acl[key])
+            if not acl_apply(config, ops):
+                continue
+            for option, key in (('allow_read', 'read'), ('allow_push', 'push')):
+                new = None
+                if config.has_option('web', option):
+                    new = config.get('web', option)
+                if new != acl[key]:
+                    diff.append((name, option, acl[key], new))
+        return diff
+
+    def sync_plan(self, policy):
+        """Returns the diff that brings the repositories in line with policy.
+
+        The diff is a list of (name, option, old, new) tuples, like
+        preview()'s, holding only the options whose set of users
+        differs.  It is computed from the ACL index, so repositories
+        whose hgrc did not change are not read at all.
+        """
+        def users(val, everyone):
+            if val in everyone:
+                return '*'
+            return val and split_users(val) or set()
+
+        diff = []
+        for name in sorted(self.available_repos):
+            wanted = policy.lookup(name)
+            if wanted is None:
+                continue
+            read, push = policy.values(wanted)
+            if read is None:
+                sys.stderr.write("Policy grants no access to repository %s; skipped.\n" % name)
+                continue
+            acl = self.index.get(name, self.path(name))
+            if not acl['web'] or users(acl['read'], (None, '*')) != users(read, ('*',)):
+                diff.append((name, 'allow_read', acl['read'], read))
+            if (not acl['web'] and push is not None) or \
+                    users(acl['push'], ('*',)) != users(push, ('*',)):
+                diff.append((name, 'allow_push', acl['push'], push))
+        return diff
+
+    def sync(self, diff, jobs=None):
+        """Write a diff returned by sync_plan() to the hgrc files.
+
+        Only the options in the diff are edited, in place, on a pool of
+        jobs threads.  Returns a list of (name, error) tuples, where
+        error is None on success.
+        """
+        plan = OrderedDict()
+        for name, option, old, new in diff:
+            plan.setdefault(name, []).append((option, new))
+        tasks = [(name, self.path(name), values) for name, values in plan.iteritems()]
+        results = thread_map(_sync_hgrc, tasks, jobs or acl_jobs)
+        for name, error in results:
+            self.index.get(name, self.path(name))
+        return results
+
+    def maintain(self, names, action, log, jobs=None, io_jobs=None, timeout=None,
+                 force=False, report=None):
+        """Run a maintenance action ('verify', 'recover' or 'scan') on names.
+
+        Each check runs in its own process, at most jobs at a time and
+        at most io_jobs on any one filesystem, and is killed after
+        timeout seconds.  Repositories whose last result in log is still
+        current are skipped unless force is set.  Results are appended
+        to log, and passed to report, as they complete.  Returns the
+        list of results.
+        """
+        import threading
+        import multiprocessing
+        io_jobs = io_jobs or maintain_io_jobs
+        timeout = timeout or maintain_timeout
+        devices = {}
+        tasks = []
+        for name in names:
+            path = self.path(name)
+            key = maintenance_key(path)
+            if not force and log.current(name, action, key):
+                continue
+            dev = os.stat(path).st_dev
+            if dev not in devices:
+                devices[dev] = threading.BoundedSemaphore(io_jobs)
+            tasks.append((name, path, key, devices[dev]))
+
+        def check(task):
+            name, path, key, io = task
+            with io:
+                start = time.time()
+                conn, child = multiprocessing.Pipe(False)
+                proc = multiprocessing.Process(target=_maintain, args=(action, path, child))
+                proc.start()
+                child.close()
+                if conn.poll(timeout):
+                    try:
+                        status, message = conn.recv()
+                    except EOFError:
+                        status, message = 'failed', 'check exited with status %s' % proc.exitcode
+                else:
+                    proc.terminate()
+                    status, message = 'timeout', 'killed after %ds' % timeout
+                proc.join()
+                conn.close()
+            rec = {'repo': name, 'action': action, 'key': key, 'status': status,
+                   'message': message, 'time': time.time(),
+                   'elapsed': round(time.time() - start, 3)}
+            log.record(rec)
+            if report:
+                report(rec)
+            return rec
+
+        with timings.phase(action):
+            return thread_map(check, tasks, jobs or maintain_jobs)
+
+    def flush(self):
+        """Persist the ACL index."""
+        self.index.save()
+
+
+class ServerState:
+    """The users files and repositories 'serve' keeps in memory.
+
+    Cached objects are revalidated against the files they were read from
+    at the start of every request, and reloaded if those have changed.
+    """
+
+    def __init__(self):
+        self.users = {}
+        self.repos = {}
+
+    def get_users(self, filename):
+        key = os.path.abspath(filename)
+        users = self.users.get(key)
+        if users is None:
+            users = self.users[key] = User(key)
+        elif users.htfile.changed():
+            users.htfile.load()
+        return users
+
+    def get_repos(self, filename):
+        key = os.path.abspath(filename)
+        st = file_stat(key)
+        cached = self.repos.get(key)
+        if cached is None or cached[0] != st:
+            repos = Repository(key)
+            self.repos[key] = (st, repos)
+        else:
+            repos = cached[1]
+            repos.revalidate()
+        return repos
+
+    def clear(self):
+        self.users = {}
+        self.repos = {}
+
+# Set by 'serve'; None when running a single command
+server_state = None
+
+def load_users(filename):
+    if server_state:
+        return server_state.get_users(filename)
+    return User(filename)
+
+def load_repos(filename):
+    if server_state:
+        return server_state.get_repos(filename)
+    return Repository(filename)
+
+class CredentialChecker:
+    """Verifies credentials against a users file, for external authenticators.
+
+    The parsed users file is reloaded whenever its stat changes, and the
+    last check_cache_size successful checks are remembered, so repeated
+    checks by the same user cost a stat and a dict lookup instead of a
+    crypt() or md5.  Passwords are only kept as HMACs under a key that
+    lives as long as the process.
+    """
+
+    def __init__(self, users_file, config_file=None):
+        self.htfile = open_users_file(users_file)
+        self.config_file = config_file
+        self.repos = None
+        self.key = os.urandom(32)
+        self.verified = OrderedDict()
+
+    def check(self, username, password):
+        """Returns True if password is the password of username."""
+        import hmac
+        from hashlib import sha1
+        if self.htfile.changed():
+            self.htfile.load()
+            self.verified.clear()
+        entry = self.htfile.get(username)
+        if not entry or len(entry) < 2:
+            return False
+
+        # Keyed by the stored hash too, so a password change is a miss
+        key = (username, entry[-1], hmac.new(self.key, password, sha1).digest())
+        if key in self.verified:
+            self.verified[key] = self.verified.pop(key)
+            timings.count('credential cache hits')
+            return True
+
+        if len(entry) == 2:
+            pwhash = crypt_module().crypt(password, entry[1])
+        else:
+            pwhash = hash_entry(username, password, entry[1])[2]
+        compare = getattr(hmac, 'compare_digest', lambda a, b: a == b)
+        if not compare(pwhash, entry[-1]):
+            return False
+        self.verified[key] = True
+        if len(self.verified) > check_cache_size:
+            self.verified.popitem(last=False)
+        return True
+
+    def allowed(self, name, username, mode='read'):
+        """Returns True if username may read (or push to) repository name."""
+        if self.repos is None:
+            self.repos = load_repos(self.config_file)
+        else:
+            self.repos.revalidate()
+        path = self.repos.path(name)
+        if not path:
+            return False
+        return acl_allows(self.repos.index.get(name, path), username, mode)
+
+    def serve(self, rfile, wfile):
+        """Answer requests, one per line, until end of file.
+
+        'auth <user> <password>' checks a password; 'read <repo> <user>'
+        and 'push <repo> <user>' check repository access.  Each request
+        is answered with a line of OK or NO (or ERR for a bad request).
+        """
+        for line in iter(rfile.readline, ''):
+            parts = line.rstrip('\r\n').split(' ', 2)
+            if len(parts) != 3:
+                wfile.write('ERR invalid request\n')
+            elif parts[0] == 'auth':
+                wfile.write(self.check(parts[1], parts[2]) and 'OK\n' or 'NO\n')
+            elif parts[0] in ('read', 'push'):
+                wfile.write(self.allowed(parts[1], parts[2], parts[0]) and 'OK\n' or 'NO\n')
+            else:
+                wfile.write('ERR unknown request %s\n' % parts[0])
+            wfile.flush()
+
+def select(items, args, key=None):
+    """Apply the --glob, --regex, --offset and --limit options to items."""
+    import itertools
+    if args.glob:
+        import fnmatch
+        items = (x for x in items if fnmatch.fnmatchcase(key and key(x) or x, args.glob))
+    if args.regex:
+        import re
+        regex = re.compile(args.regex)
+        items = (x for x in items if regex.search(key and key(x) or x))
+    stop = None
+    if args.limit is not None:
+        stop = args.offset + args.limit
+    return itertools.islice(items, args.offset, stop)
+
+def emit(records, args, text, header=None, fields=None):
+    """Print records as they are produced: as text, a JSON array, JSON lines
+    or, given the fields of each record, CSV."""
+    if args.format == 'csv':
+        import csv
+        writer = csv.DictWriter(sys.stdout, fields, extrasaction='ignore')
+        writer.writeheader()
+        for rec in records:
+            writer.writerow(rec)
+    elif args.format == 'json':
+        sep = '['
+        for rec in records:
+            sys.stdout.write(sep + json.dumps(rec, sort_keys=True))
+            sep = ',\n '
+        sys.stdout.write(sep == '[' and '[]\n' or ']\n')
+    elif args.format == 'ndjson':
+        for rec in records:
+            sys.stdout.write(json.dumps(rec, sort_keys=True) + '\n')
+    else:
+        if header:
+            print header
+        for rec in records:
+            print text(rec)
 
 def ls(args):
-    users = User(args.users_file)
-    if args.username and args.username in users.list():
-        repos = Repository(args.config_file)
-        print "User [%s]:" % args.username
-        print " ", "\n  ".join(repos.listbyuser(args.username))
+    users = load_users(args.users_file)
+    if args.username and args.username in users:
+        repos = load_repos(args.config_file)
+        records = ({'repo': r, 'path': repos.path(r),
+                    'mode': args.username in repos.listusers(r, [args.username])['rw']
+                            and 'rw' or 'ro'}
+                   for r in select(sorted(repos.listbyuser(args.username)), args))
+        emit(records, args, lambda rec: "  %s" % rec['repo'],
+             header="User [%s]:" % args.username)
+        repos.flush()
     else:
-        print "\n".join(users.list())
+        emit(({'user': u} for u in select(users.list(), args)), args,
+             lambda rec: rec['user'])
 
 def lsr(args):
-    repos = Repository(args.config_file)
-    if args.reponame and args.reponame in repos.list():
-        users = User(args.users_file)
-        print "Repository [%s]:" % args.reponame
-        rusers = repos.listusers(args.reponame, users.list())
-        for ro in rusers['ro']:
-            print "  %s (ro)" % ro
-
-        for rw in rusers['rw']:
-            print "  %s (rw)" % rw
+    repos = load_repos(args.config_file)
+    if args.reponame and args.reponame in repos:
+        users = load_users(args.users_file)
+        pairs = select(repos.iterusers(args.reponame, users.list()), args,
+                       key=lambda x: x[0])
+        emit(({'user': u, 'mode': mode} for u, mode in pairs), args,
+             lambda rec: "  %s (%s)" % (rec['user'], rec['mode']),
+             header="Repository [%s]:" % args.reponame)
+        repos.flush()
     else:
-        print "\n".join(repos.list())
+        names = select(sorted(repos.list()), args)
+        if args.format:
+            emit((repos.describe(name) for name in names), args, None)
+        else:
+            emit(names, args, lambda name: name)
+        repos.flush()
+
+def format_size(size):
+    """Returns a byte count in human-readable units."""
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'T'
+    return unit == 'B' and "%d%s" % (size, unit) or "%.1f%s" % (size, unit)
+
+stats_fields = ['repo', 'size', 'changesets', 'tip', 'ro', 'rw']
+
+def stats(args):
+    repos = load_repos(args.config_file)
+    names = list(select(sorted(repos.list()), args))
+    results = repos.stats(names, args.jobs)
+
+    everyone = None
+    records = []
+    for name in names:
+        if name not in results:
+            continue
+        acl = repos.describe(name)
+        if acl['read_all'] or acl['push_all']:
+            if everyone is None:
+                everyone = list(load_users(args.users_file).list())
+            u = repos.listusers(name, everyone)
+            ro, rw = len(u['ro']), len(u['rw'])
+        else:
+            ro, rw = len(acl['ro']), len(acl['rw'])
+        rec = results[name]
+        records.append({'repo': name, 'path': rec['path'], 'size': rec['size'],
+                        'changesets': rec['changesets'], 'tip': rec['tip'],
+                        'ro': ro, 'rw': rw})
+    repos.flush()
+
+    if args.sort != 'repo':
+        # None (no tip yet) sorts first, so the newest repositories come last
+        records.sort(key=lambda rec: rec[args.sort])
+    if args.reverse:
+        records.reverse()
+
+    def text(rec):
+        tip = rec['tip'] and time.strftime('%Y-%m-%d %H:%M', time.localtime(rec['tip'])) or '-'
+        return "%-30s %8s %10d  %-16s %5d %5d" % (
+            rec['repo'], format_size(rec['size']), rec['changesets'], tip,
+            rec['ro'], rec['rw'])
+    emit(records, args, text, fields=stats_fields,
+         header="%-30s %8s %10s  %-16s %5s %5s" % (
+             'Repository', 'Size', 'Changesets', 'Tip', 'RO', 'RW'))
+    if not args.format:
+        print "%d repositories, %s in total." % (
+            len(records), format_size(sum(rec['size'] for rec in records)))
 
 def add(args):
-    users = User(args.users_file)
-    if args.username in users.list():
+    users = load_users(args.users_file)
+    if args.username in users:
         print "User %s already exists." % args.username
     else:
         users.add(args.username, password=args.password, realm=args.realm,
                   email=args.email)
         print "User %s added." % args.username
+        if args.email:
+            send_mail(users.mailq, args)
+
+def send_mail(mailq, args):
+    """Deliver spooled notification emails, inline or in the background."""
+    if args.smtp:
+        host, _, port = args.smtp.partition(':')
+        mailq.host = host
+        mailq.port = int(port) if port else smtp_port
+    if getattr(args, 'background', False):
+        mailq.flush_in_background()
+        print "Notification emails queued for delivery."
+    else:
+        sent, failed = mailq.flush()
+        pending = len(mailq.list())
+        print "Sent %d notification email(s), %d failed, %d pending." % (
+            sent, failed, pending)
+
+def mail(args):
+    mailq = load_users(args.users_file).mailq
+    if args.action == 'ls':
+        for name, rec in mailq.list():
+            print "%s  to=%s attempts=%d due=%s%s" % (
+                name, rec['to'], rec['attempts'],
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(rec['due'])),
+                rec['error'] and "  error=%s" % rec['error'] or "")
+    else:
+        send_mail(mailq, args)
+
+def import_users(args):
+    users = load_users(args.users_file)
+    if args.file == '-':
+        f = sys.stdin
+    else:
+        f = open(args.file, 'rb')
+
+    import csv
+    records = []
+    for row in csv.reader(f):
+        if not row or not row[0].strip() or row[0].startswith('#'):
+            continue
+        row = [x.strip() for x in row] + [''] * 3
+        username, realm, email, password = row[:4]
+        # Existing users keep their realm unless the record overrides it
+        if not realm and username not in users:
+            realm = args.realm
+        records.append((username, realm, email, password))
+
+    start = time.time()
+    results = users.add_many(records, jobs=args.jobs, overwrite=args.overwrite)
+    elapsed = time.time() - start
+
+    imported = 0
+    notified = False
+    for username, password, email, status in results:
+        if status == 'exists':
+            print "User %s already exists." % username
+            continue
+        imported += 1
+        print "User %s %s." % (username, status)
+        if email:
+            users.notify_user(username, password, email)
+            notified = True
+
+    print "Imported %d of %d users in %.2fs (%.1f users/s)." % (
+        imported, len(records), elapsed, imported / elapsed if elapsed else 0)
+    if notified:
+        send_mail(users.mailq, args)
+
+def convert(args):
+    src = open_users_file(args.source)
+    try:
+        dst = open_users_file(args.dest)
+    except Exception:
+        dst = open_users_file(args.dest, create=True)
+
+    start = time.time()
+    n = 0
+    for entry in src.list():
+        dst.set(entry)
+        n += 1
+    dst.save()
+    print "Converted %d users from %s to %s in %.2fs." % (
+        n, args.source, args.dest, time.time() - start)
 
 def rm(args):
-    users = User(args.users_file)
-    if args.username in users.list():
+    users = load_users(args.users_file)
+    if args.username in users:
         yes = set(['yes','y', ''])
         no = set(['no','n'])
         if not args.force:
@@ -391,14 +2910,70 @@ def rm(args):
         else:
             choice = 'yes'
         if choice in yes:
-            repos = Repository(args.config_file)
-            users.delete(args.username)
-            for r in repos.listbyuser(args.username):
-                repos.deluser(r, args.username)
+            repos = load_repos(args.config_file)
+            plan = [(r, 'del', args.username, None)
+                    for r in repos.listbyuser(args.username)]
+            # Enough to undo the operation, should it be interrupted
+            undo = {'user': args.username, 'entry': users.htfile.get(args.username),
+                    'repos': [(r, args.username in repos.listusers(r, [args.username])['rw']
+                                  and 'rw' or 'ro') for r, _, _, _ in plan]}
+            journal = open_journal(args.config_file)
+            start = time.time()
+            id = journal.begin('rm', undo)
+            try:
+                users.delete(args.username)
+                results = repos.apply(plan, args.jobs)
+                repos.flush()
+            except:
+                journal.suspend()
+                raise
+            # Leave the operation pending for 'recover' to finish
+            if [r for r, error in results if error]:
+                journal.suspend()
+            else:
+                journal.end(id)
+            for r, error in results:
+                if error:
+                    print "Failed to delete user %s from repository %s: %s" % (args.username, r, error)
+                else:
+                    print "User %s deleted from repository %s." % (args.username, r)
+            report_acl(results, time.time() - start)
             print "User %s deleted." % args.username
     else:
         print "User %s does not exist." % args.username
 
+def report_acl(results, elapsed):
+    """Print the summary of a batch of ACL changes."""
+    failed = len([r for r, error in results if error])
+    print "Updated %d repositories in %.2fs (%d failed)." % (
+        len(results) - failed, elapsed, failed)
+
+def select_repos(repos, args):
+    """Returns the repositories named on the command line, followed by those
+    matching the --glob, --regex and --collection selectors."""
+    names = []
+    for repo in args.repos:
+        if repo not in repos:
+            print "Repository %s does not exist." % repo
+        elif repo not in names:
+            names.append(repo)
+    if args.glob or args.regex or args.collections:
+        seen = set(names)
+        for repo in repos.match(args.glob, args.regex, args.collections):
+            if repo not in seen:
+                names.append(repo)
+    if not names:
+        print "No repositories selected."
+    return names
+
+def report_preview(diff):
+    """Print the diff of a dry run of ACL changes."""
+    def show(val):
+        return val is None and '(unset)' or ' '.join(val.split())
+    for repo, option, old, new in diff:
+        print "Repository %s: %s: %s -> %s" % (repo, option, show(old), show(new))
+    print "Would update %d repositories." % len(set(d[0] for d in diff))
+
 def adduser(args):
     if args.mode:
         if args.mode != "ro" and args.mode != "rw":
@@ -407,48 +2982,146 @@ def adduser(args):
     else:
         args.mode = 'rw'
 
-    users = User(args.users_file)
-    repos = Repository(args.config_file)
-    if args.username not in users.list():
+    users = load_users(args.users_file)
+    repos = load_repos(args.config_file)
+    if args.username not in users:
         print "User %s does not exist." % args.username
     else:
-        for repo in args.repos:
-            if repo not in repos.list():
-                print "Repository %s does not exist." % repo
-                return
+        plan = []
+        for repo in select_repos(repos, args):
+            u = repos.listusers(repo)
+            if args.username in u[args.mode]:
+                print "User %s is already a member of repository %s (mode=%s)" % (args.username, repo, args.mode)
             else:
-                users = repos.listusers(repo)
-                if args.username in users[args.mode]:
-                    print "User %s is already a member of repository %s (mode=%s)" % (args.username, repo, args.mode)
-                    next
-                else:
-                    repos.adduser(repo, args.username, args.mode)
-                    print "User %s added to repository %s (mode=%s)." % (args.username, repo, args.mode)
+                plan.append((repo, 'add', args.username, args.mode))
+
+        if args.dry_run:
+            report_preview(repos.preview(plan))
+            repos.flush()
+            return
+        start = time.time()
+        results = repos.apply(plan, args.jobs)
+        for repo, error in results:
+            if error:
+                print "Failed to add user %s to repository %s: %s" % (args.username, repo, error)
+            else:
+                print "User %s added to repository %s (mode=%s)." % (args.username, repo, args.mode)
+        report_acl(results, time.time() - start)
+        repos.flush()
 
 def deluser(args):
-    users = User(args.users_file)
-    repos = Repository(args.config_file)
-    if args.username not in users.list():
+    users = load_users(args.users_file)
+    repos = load_repos(args.config_file)
+    if args.username not in users:
         print "User %s does not exist." % args.username
     else:
-        for repo in args.repos:
-            if repo not in repos.list():
-                print "Repository %s does not exist." % repo
-                return
+        plan = []
+        for repo in select_repos(repos, args):
+            u = repos.listusers(repo, [args.username])
+            if args.username not in u['ro'] and args.username not in u['rw']:
+                print "User %s is not a member of repository %s" % (args.username, repo)
             else:
-                u = repos.listusers(repo, users.list())
-                if args.username not in u['ro'] and args.username not in u['rw']:
-                    print "User %s is not a member of repository %s" % (args.username, repo)
-                    next
-                else:
-                    repos.deluser(repo, args.username)
-                    print "User %s deleted from repository %s." % (args.username, repo)
+                plan.append((repo, 'del', args.username, None))
+
+        if args.dry_run:
+            report_preview(repos.preview(plan))
+            repos.flush()
+            return
+        start = time.time()
+        results = repos.apply(plan, args.jobs)
+        for repo, error in results:
+            if error:
+                print "Failed to delete user %s from repository %s: %s" % (args.username, repo, error)
+            else:
+                print "User %s deleted from repository %s." % (args.username, repo)
+        report_acl(results, time.time() - start)
+        repos.flush()
+
+def sync(args):
+    try:
+        policy = AclPolicy(args.policy)
+    except (IOError, ConfigParser.Error), e:
+        print "Cannot load policy: %s" % e
+        return
+    users = load_users(args.users_file)
+    missing = set(u for u in policy.users() if u not in users)
+    for u in sorted(missing):
+        print "User %s does not exist." % u
+    policy.discard(missing)
+
+    repos = load_repos(args.config_file)
+    diff = repos.sync_plan(policy)
+    if args.dry_run:
+        report_preview(diff)
+        repos.flush()
+        return
+    start = time.time()
+    results = repos.sync(diff, args.jobs)
+    for repo, error in results:
+        if error:
+            print "Failed to update repository %s: %s" % (repo, error)
+        else:
+            print "Repository %s updated." % repo
+    report_acl(results, time.time() - start)
+    repos.flush()
 
 def create(args):
-    users = User(args.users_file)
-    repos = Repository(args.config_file)
+    users = load_users(args.users_file)
+    repos = load_repos(args.config_file)
+    if args.users:
+        plan = {'repos': [r for r in args.reponame if repos.target(r)[0] not in repos],
+                'users': [u for u in args.users if u in users]}
+        journal = open_journal(args.config_file)
+        id = journal.begin('create', plan)
+        try:
+            failed = create_repos(args, users, repos)
+        except:
+            journal.suspend()
+            raise
+        # Leave the operation pending for 'recover' to finish
+        if failed:
+            journal.suspend()
+        else:
+            journal.end(id)
+    else:
+        create_repos(args, users, repos)
+
+def create_repos(args, users, repos):
+    """Create the repositories of a 'create' command line.  Returns the
+    number of repositories and users that could not be set up."""
+    if args.skeleton:
+        names = []
+        for repo in args.reponame:
+            if repo in repos or repo in names:
+                print "Repository %s already exists." % repo
+            else:
+                names.append(repo)
+        members = []
+        for u in args.users or []:
+            if u in users:
+                members.append(u)
+            else:
+                print "User %s does not exist." % u
+
+        start = time.time()
+        results = repos.create_many(names, members, args.jobs, args.link)
+        failed = 0
+        for repo, error in results:
+            if error:
+                failed += 1
+                print "Failed to create repository %s: %s" % (repo, error)
+            else:
+                print "Repository %s created." % repo
+                for u in members:
+                    print "User %s added to repository %s." % (u, repo)
+        print "Created %d repositories in %.2fs (%d failed)." % (
+            len(results) - failed, time.time() - start, failed)
+        repos.flush()
+        return failed
+
+    failed = 0
     for repo in args.reponame:
-        if repo in repos.list():
+        if repo in repos:
             print "Repository %s already exists." % repo
             next
         else:
@@ -456,16 +3129,161 @@ def create(args):
             print "Repository %s created." % repo
             if args.users:
                 for u in args.users:
-                    if u in users.list():
-                        repos.adduser(repo, u)
-                        print "User %s added to repository %s." % (u, repo)
+                    if u in users:
+                        error = repos.adduser(repo, u)
+                        if error:
+                            failed += 1
+                            print "Failed to add user %s to repository %s: %s" % (u, repo, error)
+                        else:
+                            print "User %s added to repository %s." % (u, repo)
                     else:
                         print "User %s does not exist." % u
+    repos.flush()
+    return failed
+
+def replay_rm(users, repos, plan, rollback=False):
+    """Finish, or with rollback undo, an interrupted 'rm'."""
+    username = plan['user']
+    if rollback:
+        if username not in users and plan['entry']:
+            users.htfile.set(plan['entry'])
+            users.htfile.save()
+        changes = [(r, 'add', username, mode) for r, mode in plan['repos']
+                   if r in repos and username not in repos.listusers(r, [username])[mode]]
+    else:
+        if username in users:
+            users.delete(username)
+        changes = [(r, 'del', username, None) for r in repos.listbyuser(username)]
+    return repos.apply(changes)
+
+def replay_create(users, repos, plan, rollback=False):
+    """Finish, or with rollback undo, an interrupted 'create -u'."""
+    if rollback:
+        for repo in plan['repos']:
+            name = repos.target(repo)[0]
+            if name in repos:
+                repos.delete(name)
+        return []
+    changes = []
+    for repo in plan['repos']:
+        name = repos.target(repo)[0]
+        if name not in repos:
+            # Its directory may have been made before the interruption
+            repos.create(repo, existing=True)
+        rw = repos.listusers(name, plan['users'])['rw']
+        changes.extend((name, 'add', u, 'rw') for u in plan['users']
+                       if u in users and u not in rw)
+    return repos.apply(changes)
+
+# Journaled operations and the functions that recover them
+recovery = {'rm': replay_rm, 'create': replay_create}
+
+def recover(args):
+    journal = open_journal(args.config_file)
+    pending = journal.pending()
+    if not pending:
+        print "No unfinished operations."
+        return
+    users = load_users(args.users_file)
+    repos = load_repos(args.config_file)
+    action = args.rollback and 'Rolling back' or 'Replaying'
+    for id, rec in pending.iteritems():
+        print "%s %s %s (started %s)." % (
+            args.dry_run and 'Unfinished' or action, rec['op'],
+            json.dumps(rec['plan'], sort_keys=True),
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(rec['time'])))
+        if args.dry_run:
+            continue
+        start = time.time()
+        if not journal.resume(id):
+            print "Skipped: another process is running it."
+            continue
+        if id not in journal.unfinished():
+            # Ended by its own process since the journal was read
+            journal.flush()
+            journal.release(remove=True)
+            continue
+        try:
+            results = recovery[rec['op']](users, repos, rec['plan'], args.rollback)
+            repos.flush()
+        except:
+            journal.suspend()
+            raise
+        failed = [(r, error) for r, error in results if error]
+        for r, error in failed:
+            print "Failed to update repository %s: %s" % (r, error)
+        if failed:
+            journal.suspend()
+        else:
+            journal.end(id, args.rollback and 'rolled back' or 'done')
+        report_acl(results, time.time() - start)
+
+def fork(args):
+    repos = load_repos(args.config_file)
+    if args.source not in repos:
+        print "Repository %s does not exist." % args.source
+        return
+    if args.owner and args.owner not in load_users(args.users_file):
+        print "User %s does not exist." % args.owner
+        return
+    names = []
+    for repo in args.dest:
+        if repo in repos or repo in names:
+            print "Repository %s already exists." % repo
+        else:
+            names.append(repo)
+
+    start = time.time()
+    results = repos.fork(args.source, names, args.owner,
+                         args.copy_acl or not args.owner, args.jobs)
+    failed = 0
+    for repo, error in results:
+        if error:
+            failed += 1
+            print "Failed to fork repository %s: %s" % (repo, error)
+        else:
+            print "Repository %s forked from %s." % (repo, args.source)
+    print "Forked %d repositories in %.2fs (%d failed)." % (
+        len(results) - failed, time.time() - start, failed)
+    repos.flush()
+
+def maintain(args):
+    repos = load_repos(args.config_file)
+    if args.repos or args.glob or args.regex or args.collections:
+        names = select_repos(repos, args)
+    else:
+        names = sorted(repos.list())
+    configdir = os.path.dirname(os.path.abspath(args.config_file))
+    log = MaintenanceLog(os.path.join(configdir, maintain_state_file))
+    if args.dry_run:
+        for name in names:
+            if args.force or not log.current(name, args.action, maintenance_key(repos.path(name))):
+                print name
+        return
+
+    def report(rec):
+        print "%s: %s%s" % (rec['repo'], rec['status'], rec['message'] and ':' or '')
+        for line in rec['message'].splitlines():
+            print "  %s" % line
+        sys.stdout.flush()
+
+    start = time.time()
+    results = repos.maintain(names, args.action, log, args.jobs, args.io_jobs,
+                             args.timeout, args.force, report)
+    log.compact(repos.list())
+    counts = {}
+    for rec in results:
+        counts[rec['status']] = counts.get(rec['status'], 0) + 1
+    print "Checked %d repositories in %.2fs (%s); %d up to date." % (
+        len(results), time.time() - start,
+        ', '.join('%d %s' % (n, status) for status, n in sorted(counts.items())) or 'nothing to do',
+        len(names) - len(results))
 
 def delete(args):
-    repos = Repository(args.config_file)
+    repos = load_repos(args.config_file)
+    trashed = []
     for repo in args.reponame:
-        if repo in repos.list():
+        if repo in repos:
             yes = set(['yes','y', ''])
             no = set(['no','n'])
             if not args.force:
@@ -477,14 +3295,226 @@ def delete(args):
                 choice = 'yes'
 
             if choice in yes:
-                repos.delete(repo)
-                print "Repository %s deleted." % repo
+                try:
+                    trashed.append(repos.delete(repo))
+                    print "Repository %s moved to the trash." % repo
+                except OSError, e:
+                    print "Failed to delete repository %s: %s" % (repo, e)
         else:
             print "Repository %s does not exist." % repo
+    repos.flush()
+    if args.purge and trashed:
+        records = [rec for rec in repos.trash() if rec['entry'] in trashed]
+        in_background(repos.purge, records)
+        print "Purging %d repositories in the background." % len(records)
+
+def trash(args):
+    repos = load_repos(args.config_file)
+    records = repos.trash()
+    if args.names:
+        records = [rec for rec in records
+                   if rec['name'] in args.names or os.path.basename(rec['entry']) in args.names]
+    if args.older_than is not None:
+        cutoff = time.time() - args.older_than * 86400
+        records = [rec for rec in records if rec['deleted'] <= cutoff]
+
+    if args.action == 'list':
+        for rec in records:
+            print "%s  %s  (%s)" % (
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(rec['deleted'])),
+                rec['name'], os.path.basename(rec['entry']))
+            for e in rec['errors']:
+                print "  purge error: %s" % e
+        return
+
+    if args.action == 'restore':
+        if not args.names:
+            print "Name the repositories to restore."
+            return
+        # The latest copy of a repository wins
+        latest = OrderedDict((rec['name'], rec) for rec in records)
+        for rec in latest.itervalues():
+            try:
+                repos.restore(rec)
+                print "Repository %s restored." % rec['name']
+            except OSError, e:
+                print "Failed to restore repository %s: %s" % (rec['name'], e)
+        return
+
+    if not args.names and not args.all:
+        print "Name the repositories to purge, or use --all."
+        return
+    if not records:
+        print "Nothing to purge."
+        return
+    if not args.force:
+        sys.stdout.write("Are you sure you want to permanently remove %d repositories (Y/N)? "
+                         % len(records))
+        if raw_input().lower() not in set(['yes','y', '']):
+            return
 
-def main():
-    """Mercurial Repository Manager (v0.4)"""
+    if args.background:
+        in_background(repos.purge, records, args.jobs, args.rate)
+        print "Purging %d repositories in the background." % len(records)
+        return
+    start = time.time()
+    failed = 0
+    for rec, errors in repos.purge(records, args.jobs, args.rate):
+        if errors:
+            failed += 1
+            print "Failed to purge %s (%d errors):" % (os.path.basename(rec['entry']), len(errors))
+            for e in errors:
+                print "  %s" % e
+        else:
+            print "Purged %s." % os.path.basename(rec['entry'])
+    print "Purged %d repositories in %.2fs (%d failed)." % (
+        len(records) - failed, time.time() - start, failed)
+
+def handle_request(rfile, wfile, parser):
+    """Runs one command line sent by forward() and returns its output."""
+    import traceback
+    from StringIO import StringIO
+    request = json.loads(rfile.readline())
+    output = StringIO()
+    status = 0
+    cwd = os.getcwd()
+    streams = sys.stdin, sys.stdout, sys.stderr
+    sys.stdin = StringIO()
+    sys.stdout = sys.stderr = output
+    try:
+        os.chdir(request['cwd'])
+        run(request['argv'], parser, serving=True)
+    except SystemExit, e:
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
+        else:
+            print e.code
+            status = 1
+    except EOFError:
+        print "Confirmation required: use -f with --server."
+        status = 1
+    except Exception:
+        traceback.print_exc()
+        # The cached state may be half-updated
+        server_state.clear()
+        status = 1
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = streams
+        os.chdir(cwd)
+    wfile.write(json.dumps({'output': output.getvalue(),
+                            'status': status}) + '\n')
+
+def forward(path, argv):
+    """Run a command line on a 'serve' daemon.  Returns its exit status."""
+    import socket
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(path)
+    s.sendall(json.dumps({'argv': argv, 'cwd': os.getcwd()}) + '\n')
+    reply = json.loads(s.makefile('rb').readline())
+    s.close()
+    sys.stdout.write(reply['output'])
+    return reply['status']
+
+def check(args):
+    checker = CredentialChecker(args.users_file, args.config_file)
+    if args.serve:
+        checker.serve(sys.stdin, sys.stdout)
+        return
+    # Like mod_authnz_external's pipe method: username and password lines
+    username = args.username or sys.stdin.readline().rstrip('\r\n')
+    password = sys.stdin.readline().rstrip('\r\n')
+    ok = checker.check(username, password)
+    if ok and args.repo:
+        ok = checker.allowed(args.repo, username, args.mode)
+    sys.exit(not ok and 1 or 0)
+
+def serve(args):
+    import signal
+    import socket
+    import SocketServer
+    global server_state
+
+    class CommandHandler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            handle_request(self.rfile, self.wfile, self.server.parser)
+
+    path = os.path.abspath(args.socket)
+    if os.path.exists(path):
+        try:
+            forward(path, ['--version'])
+        except socket.error:
+            os.unlink(path)
+        else:
+            print "A server is already listening on %s." % path
+            return
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
 
+    server_state = ServerState()
+    umask = os.umask(0177)
+    try:
+        server = SocketServer.UnixStreamServer(path, CommandHandler)
+    finally:
+        os.umask(umask)
+    server.parser = make_parser()
+    print "Serving on %s" % path
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+def report_timings(report, args):
+    """Print a timings report, and write it as JSON if requested."""
+    if args.timings:
+        sys.stderr.write("Timings for %s: %.3fs\n" % (report['command'], report['seconds']))
+        for name, p in sorted(report['phases'].items(), key=lambda x: -x[1]['seconds']):
+            sys.stderr.write("  %-28s %9.3fs %8d calls\n" % (name, p['seconds'], p['calls']))
+        for name, n in sorted(report['counters'].items()):
+            sys.stderr.write("  %-28s %10d\n" % (name, n))
+    if args.timings_json:
+        data = json.dumps(report, sort_keys=True) + '\n'
+        if args.timings_json == '-':
+            sys.stderr.write(data)
+        else:
+            with open(args.timings_json, 'a') as f:
+                f.write(data)
+
+def add_list_options(parser):
+    """Add the filtering, paging and output options of ls and lsr."""
+    parser.add_argument('-g', '--glob', dest='glob',
+                        help='only list names matching this shell pattern')
+    parser.add_argument('-e', '--regex', dest='regex',
+                        help='only list names matching this regular expression')
+    parser.add_argument('--offset', dest='offset', type=int, default=0,
+                        help='skip this many names')
+    parser.add_argument('--limit', dest='limit', type=int,
+                        help='list at most this many names')
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument('--json', dest='format', action='store_const', const='json',
+                        help='print a JSON array')
+    output.add_argument('--ndjson', dest='format', action='store_const', const='ndjson',
+                        help='print one JSON object per line')
+    return output
+
+def add_select_options(parser, dry_run='print the ACL changes without making them'):
+    """Add the repository selectors and --dry-run of adduser, deluser and maintain."""
+    parser.add_argument('-g', '--glob', dest='glob',
+                        help='also select repositories matching this shell pattern')
+    parser.add_argument('-e', '--regex', dest='regex',
+                        help='also select repositories matching this regular expression')
+    parser.add_argument('-C', '--collection', dest='collections', action='append',
+                        help='also select repositories in this collection (name or path); '
+                        'may be repeated, and narrows --glob and --regex')
+    parser.add_argument('-n', '--dry-run', action='store_true', help=dry_run)
+
+def make_parser():
+    """Returns the command line parser."""
     parser = ArgumentParser(description = main.__doc__)
     parser.add_argument('-v', '--version', action='version', version=hg_version)
     parser.add_argument('-c', '--config', dest='config_file',
@@ -493,6 +3523,16 @@ def main():
     parser.add_argument('-u', '--users', dest='users_file',
                         default=default_users_file,
                         help='specify a users file (.htpasswd or .htdigest).')
+    parser.add_argument('-s', '--smtp', dest='smtp',
+                        help='SMTP server (host[:port]) for notification emails.')
+    parser.add_argument('-S', '--server', dest='server',
+                        help='run the command on a \'serve\' daemon listening on this socket.')
+    parser.add_argument('--profile', dest='profile', metavar='FILE',
+                        help='run the command under cProfile and dump the stats to FILE.')
+    parser.add_argument('--timings', dest='timings', action='store_true',
+                        help='report the time spent in each phase of the command.')
+    parser.add_argument('--timings-json', dest='timings_json', metavar='FILE',
+                        help='append the timings as a JSON line to FILE (- for stderr).')
 
     cmdparser = parser.add_subparsers(title='commands', help='valid commands')
 
@@ -500,6 +3540,7 @@ def main():
     ls_parser = cmdparser.add_parser('ls', help='list users')
     ls_parser.add_argument('username', action='store', help='list user details',
                            nargs='?')
+    add_list_options(ls_parser)
     ls_parser.set_defaults(func=ls)
 
     # Add users
@@ -512,49 +3553,205 @@ def main():
                             nargs='?')
     add_parser.add_argument('-e', '--email', dest='email',
                             help='notify the user through email')
+    add_parser.add_argument('-b', '--background', action='store_true',
+                            help='send the notification email in the background')
     add_parser.set_defaults(func=add)
 
+    # Bulk import users
+    import_parser = cmdparser.add_parser('import', help='import users from a CSV file')
+    import_parser.add_argument('file', action='store', nargs='?', default='-',
+                               help='CSV file of username,realm,email,password '
+                               'records (default: stdin)')
+    import_parser.add_argument('-r', '--realm', dest='realm',
+                               default='mercurial repository',
+                               help='realm for records that do not specify one')
+    import_parser.add_argument('-j', '--jobs', dest='jobs', type=int,
+                               help='number of password hashing processes')
+    import_parser.add_argument('-o', '--overwrite', action='store_true',
+                               help='reset the passwords of existing users')
+    import_parser.add_argument('-b', '--background', action='store_true',
+                               help='send notification emails in the background')
+    import_parser.set_defaults(func=import_users)
+
+    # Convert between users file formats
+    convert_parser = cmdparser.add_parser('convert', help='copy users between flat, DBM and SQLite users files')
+    convert_parser.add_argument('source', action='store', help='users file to read')
+    convert_parser.add_argument('dest', action='store',
+                                help='users file to write; existing users in it are replaced '
+                                '(format chosen by extension: %s for DBM, %s for SQLite)' % (
+                                    ', '.join(dbm_extensions), ', '.join(sqlite_extensions)))
+    convert_parser.set_defaults(func=convert)
+
+    # Notification emails
+    mail_parser = cmdparser.add_parser('mail', help='list or deliver spooled notification emails')
+    mail_parser.add_argument('action', choices=['ls', 'flush'], nargs='?', default='ls',
+                             help='list the spool, or deliver the messages that are due')
+    mail_parser.add_argument('-b', '--background', action='store_true',
+                             help='keep retrying deferred messages from a background process')
+    mail_parser.set_defaults(func=mail)
+
     # Remove users
     rm_parser = cmdparser.add_parser('rm', help='remove an existing user')
     rm_parser.add_argument('username', action='store', help='user to remove')
     rm_parser.add_argument('-f', '--force', action='store_true', help='force user removal')
+    rm_parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=acl_jobs,
+                           help='number of repositories to update concurrently')
     rm_parser.set_defaults(func=rm)
 
     # List repositories
     lsr_parser = cmdparser.add_parser('lsr', help='list repositories')
     lsr_parser.add_argument('reponame', action='store', help='list repositories',
                             nargs='?')
+    add_list_options(lsr_parser)
     lsr_parser.set_defaults(func=lsr)
 
+    # Repository statistics
+    stats_parser = cmdparser.add_parser('stats', help='report the size and activity of repositories')
+    stats_parser.add_argument('--sort', dest='sort', choices=stats_fields, default='repo',
+                              help='sort the report by this column')
+    stats_parser.add_argument('-r', '--reverse', action='store_true',
+                              help='reverse the sort order')
+    stats_parser.add_argument('-j', '--jobs', dest='jobs', type=int,
+                              help='number of repositories to read concurrently')
+    add_list_options(stats_parser).add_argument(
+        '--csv', dest='format', action='store_const', const='csv',
+        help='print comma-separated values')
+    stats_parser.set_defaults(func=stats)
+
     # Add user(s) to a repository
     adduser_parser = cmdparser.add_parser('adduser', help='add an existing user to a repository')
     adduser_parser.add_argument('username', action='store', help='username')
     adduser_parser.add_argument('-m', '--mode', dest='mode', help='mode: (ro=read-only, rw=read-write)')
+    adduser_parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=acl_jobs,
+                                help='number of repositories to update concurrently')
     adduser_parser.add_argument('repos', action='store', help='repositories to add the user to',
-                                nargs='+')
+                                nargs='*')
+    add_select_options(adduser_parser)
     adduser_parser.set_defaults(func=adduser)
 
     # Delete user(s) from a repository
     deluser_parser = cmdparser.add_parser('deluser', help='delete an existing user from a repository')
     deluser_parser.add_argument('username', action='store', help='username')
+    deluser_parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=acl_jobs,
+                                help='number of repositories to update concurrently')
     deluser_parser.add_argument('repos', action='store', help='repositories to delete the user from',
-                                nargs='+')
+                                nargs='*')
+    add_select_options(deluser_parser)
     deluser_parser.set_defaults(func=deluser)
 
+    # Apply an access policy
+    sync_parser = cmdparser.add_parser('sync', help='bring repository ACLs in line with a policy file')
+    sync_parser.add_argument('policy', action='store',
+                             help='INI file of [repository or pattern] sections with ro and rw user lists')
+    sync_parser.add_argument('-n', '--dry-run', action='store_true',
+                             help='print the ACL changes without making them')
+    sync_parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=acl_jobs,
+                             help='number of repositories to update concurrently')
+    sync_parser.set_defaults(func=sync)
+
     # Create a repository
     create_parser = cmdparser.add_parser('create', help='create a new repository')
     create_parser.add_argument('reponame', action='store', help='new repository to create', nargs='+')
     create_parser.add_argument('-u', '--users', action='store', help='users to add to the repository',
                                nargs='*')
+    create_parser.add_argument('-s', '--skeleton', action='store_true',
+                               help='run hg init once and copy the result into each repository')
+    create_parser.add_argument('-l', '--link', action='store_true',
+                               help='hard-link skeleton files instead of copying them')
+    create_parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=create_jobs,
+                               help='number of repositories to create concurrently')
     create_parser.set_defaults(func=create)
 
+    # Health checks
+    maintain_parser = cmdparser.add_parser('maintain', help='verify, recover or scan repositories in parallel')
+    maintain_parser.add_argument('action', choices=['verify', 'recover', 'scan'],
+                                 help='hg verify, hg recover followed by verify, or a cheap store scan')
+    maintain_parser.add_argument('repos', action='store', nargs='*',
+                                 help='repositories to check (default: all)')
+    add_select_options(maintain_parser, dry_run='only list the repositories that would be checked')
+    maintain_parser.add_argument('-f', '--force', action='store_true',
+                                 help='also check repositories unchanged since they last passed')
+    maintain_parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=maintain_jobs,
+                                 help='number of repositories to check concurrently')
+    maintain_parser.add_argument('--io-jobs', dest='io_jobs', type=int, default=maintain_io_jobs,
+                                 help='number of concurrent checks on any one filesystem')
+    maintain_parser.add_argument('-t', '--timeout', dest='timeout', type=int, default=maintain_timeout,
+                                 help='seconds after which a check is killed')
+    maintain_parser.set_defaults(func=maintain)
+
+    # Recover interrupted operations
+    recover_parser = cmdparser.add_parser('recover', help='finish or undo operations interrupted by a crash')
+    recover_parser.add_argument('-r', '--rollback', action='store_true',
+                                help='undo the operations instead of finishing them')
+    recover_parser.add_argument('-n', '--dry-run', action='store_true',
+                                help='only list the unfinished operations')
+    recover_parser.set_defaults(func=recover)
+
+    # Fork a repository
+    fork_parser = cmdparser.add_parser('fork', help='clone a repository locally, hard-linking its store')
+    fork_parser.add_argument('source', action='store', help='repository to fork')
+    fork_parser.add_argument('dest', action='store', nargs='+', help='new repositories to create')
+    fork_parser.add_argument('-o', '--owner', dest='owner',
+                             help='give this user the new repositories, instead of the source\'s ACLs')
+    fork_parser.add_argument('-a', '--copy-acl', action='store_true',
+                             help='with --owner, also copy the source\'s ACLs')
+    fork_parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=create_jobs,
+                             help='number of repositories to fork concurrently')
+    fork_parser.set_defaults(func=fork)
+
     # Delete a repository
     delete_parser = cmdparser.add_parser('delete', help='delete an existing repository')
     delete_parser.add_argument('reponame', action='store', help='repository to delete', nargs='+')
     delete_parser.add_argument('-f', '--force', action='store_true', help='force repository removal')
+    delete_parser.add_argument('-p', '--purge', action='store_true',
+                               help='purge the deleted repositories from the trash in the background')
     delete_parser.set_defaults(func=delete)
 
-    args = parser.parse_args()
+    # Manage deleted repositories
+    trash_parser = cmdparser.add_parser('trash', help='list, restore or purge deleted repositories')
+    trash_parser.add_argument('action', choices=['list', 'restore', 'purge'], nargs='?',
+                              default='list', help='action to take')
+    trash_parser.add_argument('names', action='store', nargs='*',
+                              help='repositories or trash entries to act on '
+                              '(default: all, which purge only does with --all)')
+    trash_parser.add_argument('-a', '--all', action='store_true',
+                              help='purge every trashed repository')
+    trash_parser.add_argument('-f', '--force', action='store_true',
+                              help='purge without asking for confirmation')
+    trash_parser.add_argument('-o', '--older-than', dest='older_than', type=float, metavar='DAYS',
+                              help='only act on repositories deleted at least DAYS days ago')
+    trash_parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=purge_jobs,
+                              help='number of repositories to purge concurrently')
+    trash_parser.add_argument('--rate', dest='rate', type=float, default=purge_rate,
+                              help='files and directories removed per second (0 for no limit)')
+    trash_parser.add_argument('-b', '--background', action='store_true',
+                              help='purge from a background process')
+    trash_parser.set_defaults(func=trash)
+
+    # Check credentials for an external authenticator
+    check_parser = cmdparser.add_parser('check', help='check a password (read from stdin) and repository access')
+    check_parser.add_argument('username', action='store', nargs='?',
+                              help='user to check (default: first line of stdin)')
+    check_parser.add_argument('-r', '--repo', dest='repo',
+                              help='also check access to this repository')
+    check_parser.add_argument('-m', '--mode', dest='mode', choices=['read', 'push'],
+                              default='read', help='access to check with --repo')
+    check_parser.add_argument('--serve', action='store_true',
+                              help='answer auth/read/push requests on stdin until EOF')
+    check_parser.set_defaults(func=check, banner=False)
+
+    # Serve commands over a Unix socket
+    serve_parser = cmdparser.add_parser('serve', help='run as a daemon serving commands over a Unix socket')
+    serve_parser.add_argument('socket', action='store', nargs='?', default=default_socket,
+                              help='socket to listen on')
+    serve_parser.set_defaults(func=serve)
+
+    return parser
+
+def run(argv, parser=None, serving=False):
+    if parser is None:
+        parser = make_parser()
+    args = parser.parse_args(argv)
 
     def syntax_error(msg):
         """Utility function for displaying fatal error messages with usage help."""
@@ -562,11 +3759,70 @@ def main():
         sys.stderr.write(parser.get_usage())
         sys.exit(1)
 
-    print main.__doc__
-    print "Configuration file:", args.config_file
-    print "Users file:", args.users_file
+    if args.server and not serving and args.func is not serve:
+        sys.exit(forward(args.server, argv))
+
+    if getattr(args, 'banner', True) and not getattr(args, 'format', None):
+        print main.__doc__
+        print "Configuration file:", args.config_file
+        print "Users file:", args.users_file
 
-    args.func(args)
+    timings.reset()
+    try:
+        if args.profile:
+            import cProfile
+            import pstats
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(args.func, args)
+            finally:
+                profiler.dump_stats(args.profile)
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+        else:
+            args.func(args)
+    finally:
+        if args.timings or args.timings_json:
+            report_timings(timings.report(args.func.__name__), args)
+
+# Global options that take a value, for server_option()
+global_value_options = ['-c', '--config', '-u', '--users', '-s', '--smtp',
+                        '-S', '--server', '--profile', '--timings-json']
+
+def server_option(argv):
+    """Returns the -S/--server socket of a command line, or None if there
+    is none or the command is 'serve' or a help request.
+
+    Only the global options before the command are looked at, without
+    building the argument parser, so forwarding to a daemon stays cheap.
+    """
+    server = None
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if not arg.startswith('-'):
+            break
+        if arg in ('-h', '--help'):
+            return None
+        name, eq, value = arg.partition('=')
+        if arg.startswith('-S') and len(arg) > 2:
+            name, value = '-S', arg[2:]
+        elif name in global_value_options and not eq:
+            i += 1
+            value = i < len(argv) and argv[i] or None
+        if name in ('-S', '--server'):
+            server = value
+        i += 1
+    rest = argv[i:]
+    if not rest or rest[0] == 'serve' or '-h' in rest or '--help' in rest:
+        return None
+    return server
+
+def main():
+    """Mercurial Repository Manager (v0.4)"""
+    server = server_option(sys.argv[1:])
+    if server:
+        sys.exit(forward(server, sys.argv[1:]))
+    run(sys.argv[1:])
 
 if __name__ == '__main__':
     main()